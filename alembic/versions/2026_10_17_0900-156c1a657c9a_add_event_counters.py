@@ -0,0 +1,52 @@
+"""add_event_counters
+
+Revision ID: 156c1a657c9a
+Revises: f3e74a45a435
+Create Date: 2026-10-17 09:00:12.418305
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '156c1a657c9a'
+down_revision: Union[str, None] = 'f3e74a45a435'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('events', sa.Column('registration_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('events', sa.Column('paid_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('events', sa.Column('total_income', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('events', sa.Column('expected_income', sa.Integer(), server_default='0', nullable=False))
+    op.execute(
+        """
+        UPDATE events SET
+            registration_count = counters.registration_count,
+            paid_count = counters.paid_count,
+            total_income = counters.total_income,
+            expected_income = counters.expected_income
+        FROM (
+            SELECT
+                event_id,
+                count(*) AS registration_count,
+                count(*) FILTER (WHERE status = 'paid') AS paid_count,
+                sum(coalesce(billed_amount, 0) - coalesce(refund_amount, 0)) AS total_income,
+                sum(coalesce(price, 0)) AS expected_income
+            FROM registrations
+            GROUP BY event_id
+        ) AS counters
+        WHERE counters.event_id = events.id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('events', 'expected_income')
+    op.drop_column('events', 'total_income')
+    op.drop_column('events', 'paid_count')
+    op.drop_column('events', 'registration_count')
@@ -0,0 +1,55 @@
+"""add_trigram_search_indexes
+
+Revision ID: 7d2e9c41b0a8
+Revises: 156c1a657c9a
+Create Date: 2026-10-17 10:00:41.275310
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from app.migration_utils import drop_invalid_index
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7d2e9c41b0a8'
+down_revision: Union[str, None] = '156c1a657c9a'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SEARCH_COLUMNS = {
+    'events': ('title', 'description', 'location'),
+    'visitors': ('first_name', 'last_name', 'email'),
+}
+
+
+def upgrade() -> None:
+    op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    with op.get_context().autocommit_block():
+        for table, columns in SEARCH_COLUMNS.items():
+            for column in columns:
+                drop_invalid_index(f'ix_{table}_{column}_trgm', table)
+                op.create_index(
+                    f'ix_{table}_{column}_trgm',
+                    table,
+                    [column],
+                    unique=False,
+                    postgresql_using='gin',
+                    postgresql_ops={column: 'gin_trgm_ops'},
+                    postgresql_concurrently=True,
+                    if_not_exists=True,
+                )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for table, columns in SEARCH_COLUMNS.items():
+            for column in columns:
+                op.drop_index(
+                    f'ix_{table}_{column}_trgm',
+                    table_name=table,
+                    postgresql_concurrently=True,
+                    if_exists=True,
+                )
@@ -0,0 +1,38 @@
+"""add_event_reserved_count
+
+Revision ID: 3b1f0e7a9c52
+Revises: 7d2e9c41b0a8
+Create Date: 2026-10-17 11:00:41.902144
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b1f0e7a9c52'
+down_revision: Union[str, None] = '7d2e9c41b0a8'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('events', sa.Column('reserved_count', sa.Integer(), server_default='0', nullable=False))
+    op.execute(
+        """
+        UPDATE events SET reserved_count = counters.reserved_count
+        FROM (
+            SELECT event_id, count(*) AS reserved_count
+            FROM registrations
+            WHERE status NOT IN ('refunded', 'cancelled')
+            GROUP BY event_id
+        ) AS counters
+        WHERE counters.event_id = events.id
+        """
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('events', 'reserved_count')
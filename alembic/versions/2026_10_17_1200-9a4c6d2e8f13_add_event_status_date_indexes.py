@@ -0,0 +1,50 @@
+"""add_event_status_date_indexes
+
+Revision ID: 9a4c6d2e8f13
+Revises: 3b1f0e7a9c52
+Create Date: 2026-10-17 12:00:08.531774
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from app.migration_utils import drop_invalid_index
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9a4c6d2e8f13'
+down_revision: Union[str, None] = '3b1f0e7a9c52'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+INDEXES = {
+    'ix_events_status_start_at': ['status', 'start_at'],
+    'ix_events_status_end_at': ['status', 'end_at'],
+}
+
+
+def upgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, columns in INDEXES.items():
+            drop_invalid_index(name, 'events')
+            op.create_index(
+                name,
+                'events',
+                columns,
+                unique=False,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name in INDEXES:
+            op.drop_index(
+                name,
+                table_name='events',
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
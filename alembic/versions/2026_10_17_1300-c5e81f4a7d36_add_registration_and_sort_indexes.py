@@ -0,0 +1,85 @@
+"""add_registration_and_sort_indexes
+
+Revision ID: c5e81f4a7d36
+Revises: 9a4c6d2e8f13
+Create Date: 2026-10-17 13:00:27.114590
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+from app.migration_utils import drop_invalid_index
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c5e81f4a7d36'
+down_revision: Union[str, None] = '9a4c6d2e8f13'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+SORT_COLUMNS = {
+    'events': ('start_at', 'end_at', 'price', 'created_at'),
+    'visitors': ('created_at',),
+    'registrations': ('price', 'billed_amount', 'refund_amount', 'billed_at', 'refunded_at'),
+}
+INDEXES = [
+    ('ux_registrations_event_id_visitor_id', 'registrations', ['event_id', 'visitor_id'], True),
+    ('ix_registrations_event_id_status', 'registrations', ['event_id', 'status'], False),
+] + [
+    (f'ix_{table}_{column}_id', table, [column, 'id'], False)
+    for table, columns in SORT_COLUMNS.items()
+    for column in columns
+]
+# сколько пар дублей перечислить в ошибке
+DUPLICATES_REPORTED = 50
+
+
+def upgrade() -> None:
+    # уникальный индекс не построится на дублях; какую из оплаченных или
+    # выставленных регистраций оставить, решает человек, а не миграция
+    duplicates = op.get_bind().execute(
+        sa.text(
+            """
+            SELECT event_id, visitor_id, array_agg(id ORDER BY id) AS ids
+            FROM registrations
+            GROUP BY event_id, visitor_id
+            HAVING count(*) > 1
+            ORDER BY event_id, visitor_id
+            """
+        )
+    ).all()
+    if duplicates:
+        pairs = '\n'.join(
+            f'  event_id={event_id} visitor_id={visitor_id} registrations={ids}'
+            for event_id, visitor_id, ids in duplicates[:DUPLICATES_REPORTED]
+        )
+        more = len(duplicates) - DUPLICATES_REPORTED
+        raise RuntimeError(
+            f'{len(duplicates)} duplicated (event_id, visitor_id) registrations, '
+            f'remove them and run the migration again:\n{pairs}'
+            + (f'\n  ... and {more} more' if more > 0 else '')
+        )
+    with op.get_context().autocommit_block():
+        for name, table, columns, unique in INDEXES:
+            drop_invalid_index(name, table)
+            op.create_index(
+                name,
+                table,
+                columns,
+                unique=unique,
+                postgresql_concurrently=True,
+                if_not_exists=True,
+            )
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, _columns, _unique in INDEXES:
+            op.drop_index(
+                name,
+                table_name=table,
+                postgresql_concurrently=True,
+                if_exists=True,
+            )
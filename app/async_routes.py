@@ -0,0 +1,199 @@
+"""async routes"""
+#pylint: disable=R0801,R0913,R0914,R0917
+from fastapi import Depends, Request, HTTPException, Query, APIRouter
+from fastapi.responses import HTMLResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import models, queries, schemas
+from .cache import (
+    cached_event,
+    cached_page,
+    cached_registration_filters,
+    cached_visitor,
+    cached_visitor_events_count,
+    store_page,
+)
+from .database import get_async_read_db
+from .templating import templates
+from .utils import Keyset, PAGE_SIZE, MAX_PAGE_SIZE, page_links, build_url_with_query
+
+async_api = APIRouter(
+    tags=["API"],
+)
+
+
+@async_api.get("/events/", response_class=HTMLResponse)
+async def get_events(
+    request: Request,
+    db: AsyncSession = Depends(get_async_read_db),
+    visitor_id=Query(None),
+    sort_by: str = Query(None),
+    sort_order: int = Query(None),
+    search: str = Query(None),
+    status: str = Query(None),
+    after: str = Query(None),
+    before: str = Query(None),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    """get_events"""
+    if not (visitor_id == "" or visitor_id is None or visitor_id.isdigit()):
+        raise HTTPException(status_code=400, detail="Invalid visitor id")
+    cached, stamp = cached_page(request, queries.EVENT_PAGE_TABLES)
+    if cached is not None:
+        return cached
+    query = queries.events_query(visitor_id, search, status)
+    rank = queries.search_rank(
+        queries.EVENT_SEARCH_COLUMNS, search, queries.dialect_name(db)
+    )
+    keyset = Keyset(models.Event, sort_by, sort_order, after, before, limit, rank)
+    events, next_cursor, prev_cursor = await db.run_sync(
+        queries.keyset_page, keyset, query
+    )
+    response = templates.TemplateResponse(
+        request,
+        "event/index.html",
+        {
+            "request": request,
+            "events": events,
+            **page_links(request, next_cursor, prev_cursor),
+            "sort_by": sort_by,
+            "sort_order": sort_order,
+            "search": search,
+            "statuses": schemas.EVENT_STATUSES,
+            "status": status,
+        },
+    )
+    return store_page(request, queries.EVENT_PAGE_TABLES, stamp, response)
+
+
+@async_api.get("/events/{event_id}", response_model=schemas.Event)
+async def read_event(
+    event_id: int, request: Request, db: AsyncSession = Depends(get_async_read_db)
+):
+    """read_event"""
+    cached, stamp = cached_page(request, queries.EVENT_PAGE_TABLES)
+    if cached is not None:
+        return cached
+    db_event = await db.run_sync(cached_event, event_id)
+    if db_event is None:
+        raise HTTPException(status_code=404, detail="Event not found")
+    response = templates.TemplateResponse(
+        request,
+        "event/view.html",
+        {
+            "request": request,
+            "event": db_event,
+            "build_url_with_query": build_url_with_query,
+        },
+    )
+    return store_page(request, queries.EVENT_PAGE_TABLES, stamp, response)
+
+
+@async_api.get("/visitors/", response_class=HTMLResponse)
+async def get_visitors(
+    request: Request,
+    db: AsyncSession = Depends(get_async_read_db),
+    event_id: int = Query(None),
+    sort_by: str = Query(None),
+    sort_order: int = Query(None),
+    search: str = Query(None),
+    after: str = Query(None),
+    before: str = Query(None),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    """get_visitors"""
+    cached, stamp = cached_page(request, queries.VISITOR_PAGE_TABLES)
+    if cached is not None:
+        return cached
+    query = queries.visitors_query(event_id, search)
+    rank = queries.search_rank(
+        queries.VISITOR_SEARCH_COLUMNS, search, queries.dialect_name(db)
+    )
+    keyset = Keyset(models.Visitor, sort_by, sort_order, after, before, limit, rank)
+    visitors, next_cursor, prev_cursor = await db.run_sync(
+        queries.keyset_page, keyset, query
+    )
+    response = templates.TemplateResponse(
+        request,
+        "visitor/index.html",
+        {
+            "request": request,
+            "visitors": visitors,
+            **page_links(request, next_cursor, prev_cursor),
+            "sort_by": sort_by,
+            "sort_order": sort_order,
+        },
+    )
+    return store_page(request, queries.VISITOR_PAGE_TABLES, stamp, response)
+
+
+@async_api.get("/visitors/{visitor_id}", response_model=schemas.Visitor)
+async def read_visitor(
+    visitor_id: int, request: Request, db: AsyncSession = Depends(get_async_read_db)
+):
+    """read_visitor"""
+    cached, stamp = cached_page(request, queries.VISITOR_PAGE_TABLES)
+    if cached is not None:
+        return cached
+    db_visitor = await db.run_sync(cached_visitor, visitor_id)
+    if db_visitor is None:
+        raise HTTPException(status_code=404, detail="Visitor not found")
+    events_count = await db.run_sync(cached_visitor_events_count, visitor_id)
+    response = templates.TemplateResponse(
+        request,
+        "visitor/view.html",
+        {
+            "request": request,
+            "visitor": db_visitor,
+            "events_count": events_count,
+            "build_url_with_query": build_url_with_query,
+        },
+    )
+    return store_page(request, queries.VISITOR_PAGE_TABLES, stamp, response)
+
+
+@async_api.get("/registrations/", response_class=HTMLResponse)
+async def get_registrations(
+    request: Request,
+    db: AsyncSession = Depends(get_async_read_db),
+    event_id=Query(None),
+    visitor_id=Query(None),
+    sort_by: str = Query(None),
+    sort_order: int = Query(None),
+    status: str = Query(None),
+    after: str = Query(None),
+    before: str = Query(None),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    """get_registrations"""
+    if not (event_id == "" or event_id is None or event_id.isdigit()):
+        raise HTTPException(status_code=400, detail="Invalid event id")
+    if not (visitor_id == "" or visitor_id is None or visitor_id.isdigit()):
+        raise HTTPException(status_code=400, detail="Invalid visitor id")
+    cached, stamp = cached_page(request, queries.REGISTRATION_PAGE_TABLES)
+    if cached is not None:
+        return cached
+    query = queries.registrations_query(event_id, visitor_id, status)
+    events, visitors = await db.run_sync(cached_registration_filters)
+    keyset = Keyset(models.Registration, sort_by, sort_order, after, before, limit)
+    registrations, next_cursor, prev_cursor = await db.run_sync(
+        queries.keyset_page, keyset, query
+    )
+    response = templates.TemplateResponse(
+        request,
+        "registration/index.html",
+        {
+            "request": request,
+            "registrations": registrations,
+            **page_links(request, next_cursor, prev_cursor),
+            "sort_by": sort_by,
+            "sort_order": sort_order,
+            "statuses": schemas.REGISTRATION_STATUSES,
+            "status": status,
+            "event_id": event_id,
+            "events": events,
+            "visitors": visitors,
+            "visitor_id": visitor_id,
+        },
+    )
+    return store_page(request, queries.REGISTRATION_PAGE_TABLES, stamp, response)
@@ -0,0 +1,234 @@
+"""bus"""
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+from uuid import uuid4
+
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
+
+from . import cache, metrics
+from .database import DB_POOLER_MODE, SQLALCHEMY_DATABASE_URL
+
+# "" - выключена, postgres - LISTEN/NOTIFY основной базы,
+# file:/path - общий файл сообщений для тестов и запуска без Postgres
+INVALIDATION_BUS = os.getenv("INVALIDATION_BUS", "")
+INVALIDATION_CHANNEL = os.getenv("INVALIDATION_CHANNEL", "cache_invalidation")
+# прямое соединение с Postgres для LISTEN, по умолчанию DATABASE_URL; пулер в
+# режиме transaction отдаёт серверное соединение другим клиентам и подписка теряется
+INVALIDATION_DATABASE_URL = os.getenv("INVALIDATION_DATABASE_URL", "")
+# как часто поток шины отправляет накопленное и проверяет входящие, секунды
+INVALIDATION_POLL_INTERVAL = float(os.getenv("INVALIDATION_POLL_INTERVAL", "0.1"))
+INVALIDATION_RETRY = float(os.getenv("INVALIDATION_RETRY", "1"))
+OUTBOX_SIZE = 1000
+# payload NOTIFY ограничен 8000 байт
+MAX_PAYLOAD = 7900
+
+logger = logging.getLogger(__name__)
+
+
+class PostgresTransport:
+    """LISTEN/NOTIFY on a dedicated connection outside the pool"""
+
+    def __init__(self, url, channel=INVALIDATION_CHANNEL):
+        self.engine = create_engine(url, poolclass=NullPool)
+        self.channel = channel
+        self.connection = None
+
+    def connect(self):
+        """connect"""
+        self.connection = self.engine.raw_connection()
+        self.connection.driver_connection.autocommit = True
+        with self.connection.cursor() as cursor:
+            cursor.execute(f'LISTEN "{self.channel}"')
+
+    def publish(self, payload):
+        """publish"""
+        with self.connection.cursor() as cursor:
+            cursor.execute("SELECT pg_notify(%s, %s)", (self.channel, payload))
+
+    def receive(self, timeout):
+        """payloads delivered within timeout"""
+        dbapi_connection = self.connection.driver_connection
+        if not dbapi_connection.notifies:
+            select.select([dbapi_connection], [], [], timeout)
+            dbapi_connection.poll()
+        payloads = [notify.payload for notify in dbapi_connection.notifies]
+        dbapi_connection.notifies.clear()
+        return payloads
+
+    def close(self):
+        """close"""
+        if self.connection is not None:
+            self.connection.invalidate()
+            self.connection = None
+
+
+class FileTransport:
+    """messages appended as lines to one file and tailed by every worker,
+    a stand-in for LISTEN/NOTIFY in tests and single-host runs"""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def connect(self):
+        """starts at the end, earlier messages are not replayed"""
+        with open(self.path, "ab") as stream:
+            self.offset = stream.tell()
+
+    def publish(self, payload):
+        """publish"""
+        # одна запись с O_APPEND не перемешивается с записями других процессов
+        descriptor = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        try:
+            os.write(descriptor, payload.encode() + b"\n")
+        finally:
+            os.close(descriptor)
+
+    def receive(self, timeout):
+        """complete lines appended since the last call"""
+        with open(self.path, "rb") as stream:
+            stream.seek(self.offset)
+            data = stream.read()
+        end = data.rfind(b"\n") + 1
+        if not end:
+            time.sleep(timeout)
+            return []
+        self.offset += end
+        return [line.decode() for line in data[:end].splitlines() if line]
+
+    def close(self):
+        """close"""
+
+
+class InvalidationBus:
+    """carries the changes of every commit to the caches of the other workers.
+
+    Staleness stays bounded: a message normally arrives within the poll
+    interval; after a reconnect the local caches are cleared, because
+    messages sent meanwhile are gone; a message lost any other way is covered
+    by ENTITY_CACHE_TTL and PAGE_CACHE_TTL.
+    """
+
+    def __init__(self, transport, poll_interval=INVALIDATION_POLL_INTERVAL):
+        self.transport = transport
+        self.poll_interval = poll_interval
+        self.origin = uuid4().hex
+        self.outbox = queue.Queue(maxsize=OUTBOX_SIZE)
+        # переполненная очередь заменяется одним сообщением "сбросить всё"
+        self.overflowed = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def publish(self, change):
+        """queues a commit change, never blocks the committing request"""
+        try:
+            self.outbox.put_nowait(change)
+        except queue.Full:
+            self.overflowed = True
+
+    def encode(self, change) -> str:
+        """encode"""
+        payload = json.dumps({"origin": self.origin, **change})
+        if len(payload) > MAX_PAYLOAD:
+            # слишком много строк: получатели сбросят таблицы целиком
+            payload = json.dumps(
+                {
+                    "origin": self.origin,
+                    "tables": change["tables"],
+                    "keys": [],
+                    "bulk": change["tables"],
+                }
+            )
+        return payload
+
+    def handle(self, payload):
+        """applies a message of another worker to the local caches"""
+        message = json.loads(payload)
+        if message.pop("origin", None) == self.origin:
+            return
+        metrics.INVALIDATION_MESSAGES.labels("received").inc()
+        if message.pop("all", False):
+            cache.clear_all()
+        else:
+            cache.apply_change(**message)
+
+    def flush(self):
+        """sends queued changes"""
+        if self.overflowed:
+            self.overflowed = False
+            while not self.outbox.empty():
+                self.outbox.get_nowait()
+            self.transport.publish(json.dumps({"origin": self.origin, "all": True}))
+            metrics.INVALIDATION_MESSAGES.labels("sent").inc()
+        while not self.outbox.empty():
+            change = self.outbox.get_nowait()
+            try:
+                self.transport.publish(self.encode(change))
+            except Exception:
+                # вернём при переподключении: получатели сбросят кэш целиком
+                self.overflowed = True
+                raise
+            metrics.INVALIDATION_MESSAGES.labels("sent").inc()
+
+    def step(self):
+        """one round: send what is queued, apply what arrived"""
+        self.flush()
+        for payload in self.transport.receive(self.poll_interval):
+            self.handle(payload)
+
+    def run(self):
+        """connects at least once, so changes queued before stop() are sent"""
+        while True:
+            try:
+                self.transport.connect()
+                # пока соединения не было, сообщения могли потеряться
+                cache.clear_all()
+                while not self._stop.is_set():
+                    self.step()
+                self.flush()
+                return
+            except Exception:  # pylint: disable=W0718
+                logger.exception("invalidation bus failed, reconnecting")
+                if self._stop.wait(INVALIDATION_RETRY):
+                    return
+            finally:
+                self.transport.close()
+
+    def start(self):
+        """subscribes to local commits and starts the bus thread"""
+        cache.change_listeners.append(self.publish)
+        cache.bus_state.attach()
+        self._thread = threading.Thread(
+            target=self.run, name="invalidation-bus", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """sends what is still queued and stops the thread"""
+        self._stop.set()
+        cache.bus_state.detach()
+        if self.publish in cache.change_listeners:
+            cache.change_listeners.remove(self.publish)
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+
+def configured_bus():
+    """bus selected by INVALIDATION_BUS, None when it is off"""
+    if INVALIDATION_BUS == "postgres":
+        if not INVALIDATION_DATABASE_URL and DB_POOLER_MODE == "transaction":
+            raise RuntimeError(
+                "INVALIDATION_BUS=postgres with DB_POOLER_MODE=transaction "
+                "needs a direct INVALIDATION_DATABASE_URL"
+            )
+        url = INVALIDATION_DATABASE_URL or SQLALCHEMY_DATABASE_URL
+        return InvalidationBus(PostgresTransport(url))
+    if INVALIDATION_BUS.startswith("file:"):
+        return InvalidationBus(FileTransport(INVALIDATION_BUS[len("file:"):]))
+    return None
@@ -0,0 +1,511 @@
+"""cache"""
+import os
+import time
+from collections import OrderedDict, defaultdict
+from threading import Lock
+from uuid import uuid4
+
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from starlette.responses import HTMLResponse, Response
+
+from . import models, queries
+from .database import DB_PRIMARY_PIN_SECONDS, DB_REPLICA_URLS, Base
+
+CHANGED_TABLES = "changed_tables"
+CHANGED_ENTITIES = "changed_entities"
+BULK_TABLES = "bulk_tables"
+
+
+class TableCache:
+    """values derived from tables, dropped after a commit touches any of them;
+    ttl bounds the age of a value whose invalidation from another worker was lost"""
+
+    def __init__(self, max_size=None, ttl=None):
+        self._values = {}
+        self._tables = {}
+        self._lock = Lock()
+        self.max_size = max_size
+        self.ttl = ttl
+
+    def _fresh(self, key):
+        """_fresh"""
+        item = self._values.get(key)
+        if item is None:
+            return False
+        if item[0] is not None and item[0] <= time.monotonic():
+            del self._values[key]
+            del self._tables[key]
+            return False
+        return True
+
+    def get(self, key, default=None):
+        """get"""
+        with self._lock:
+            return self._values[key][1] if self._fresh(key) else default
+
+    def set(self, key, tables, value):
+        """set"""
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        with self._lock:
+            self._values.pop(key, None)
+            self._values[key] = (expires_at, value)
+            self._tables[key] = frozenset(tables)
+            if self.max_size is not None and len(self._values) > self.max_size:
+                oldest = next(iter(self._values))
+                del self._values[oldest]
+                del self._tables[oldest]
+
+    def get_or_load(self, key, tables, loader):
+        """get_or_load"""
+        with self._lock:
+            if self._fresh(key):
+                return self._values[key][1]
+        value = loader()
+        self.set(key, tables, value)
+        return value
+
+    def invalidate(self, tables):
+        """invalidate"""
+        tables = set(tables)
+        with self._lock:
+            for key in [k for k, deps in self._tables.items() if deps & tables]:
+                del self._values[key]
+                del self._tables[key]
+
+    def clear(self):
+        """clear"""
+        with self._lock:
+            self._values.clear()
+            self._tables.clear()
+
+
+class TableVersions:
+    """per-table version counters bumped on every commit that touches a table"""
+
+    def __init__(self):
+        # эпоха процесса: версии разных воркеров и перезапусков не совпадут
+        self.epoch = uuid4().hex[:12]
+        self._versions = defaultdict(int)
+        self._bumped_at = {}
+        self._lock = Lock()
+
+    def bump(self, tables):
+        """bump"""
+        now = time.monotonic()
+        with self._lock:
+            for table in tables:
+                self._versions[table] += 1
+                self._bumped_at[table] = now
+
+    def changed_within(self, tables, seconds) -> bool:
+        """changed_within"""
+        since = time.monotonic() - seconds
+        with self._lock:
+            return any(self._bumped_at.get(table, since) > since for table in tables)
+
+    def stamp(self, tables) -> str:
+        """stamp"""
+        with self._lock:
+            versions = ".".join(str(self._versions[table]) for table in sorted(tables))
+        return f"{self.epoch}-{versions}"
+
+
+class LocalBackend:
+    """bounded LRU with expiry in the memory of this process; a shared backend
+    (redis, memcached) replaces it by implementing the same six methods"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._values = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """value or None when missing or expired"""
+        now = time.monotonic()
+        with self._lock:
+            item = self._values.get(key)
+            if item is None or item[0] <= now:
+                if item is not None:
+                    del self._values[key]
+                self.misses += 1
+                return None
+            self._values.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key, value):
+        """set"""
+        with self._lock:
+            self._values.pop(key, None)
+            self._values[key] = (time.monotonic() + self.ttl, value)
+            while len(self._values) > self.max_size:
+                self._values.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, keys):
+        """delete"""
+        with self._lock:
+            for key in keys:
+                self._values.pop(key, None)
+
+    def delete_prefix(self, prefixes):
+        """delete_prefix"""
+        prefixes = tuple(prefixes)
+        with self._lock:
+            for key in [k for k in self._values if k.startswith(prefixes)]:
+                del self._values[key]
+
+    def clear(self):
+        """clear"""
+        with self._lock:
+            self._values.clear()
+
+    def stats(self) -> dict:
+        """stats"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._values),
+                "max_size": self.max_size,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
+
+
+# auto - кэш сущностей работает, пока воркер подключён к шине инвалидации,
+# как и PAGE_CACHE; on - для одного воркера без шины; off - выключен
+ENTITY_CACHE = os.getenv("ENTITY_CACHE", "auto")
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", "10000"))
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", "60"))
+# пространства ключей, которые устаревают при изменении таблицы
+ENTITY_NAMESPACES = {
+    "events": ("events",),
+    "visitors": ("visitors",),
+    "registrations": ("events", "visitors", "visitor_events"),
+}
+# таблицы, от которых зависят значения пространства ключей
+ENTITY_TABLES = {
+    "events": ("events", "registrations"),
+    "visitors": ("visitors", "registrations"),
+    "visitor_events": ("registrations",),
+}
+
+
+def entity_key(namespace, entity_id) -> str:
+    """entity_key"""
+    return f"{namespace}:{entity_id}"
+
+
+class EntityCache:
+    """column values of rows and per-row aggregates by primary key"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def enabled() -> bool:
+        """whether commits of the other workers reach this cache"""
+        return ENTITY_CACHE == "on" or (ENTITY_CACHE == "auto" and bus_state.attached)
+
+    def get_entity(self, model, entity_id):
+        """detached instance built from the cached columns, or None"""
+        values = self.get(entity_key(model.__tablename__, entity_id))
+        if values is None:
+            return None
+        return model(**values)
+
+    def store_entity(self, instance):
+        """stores loaded column values, deferred ones that were not loaded are
+        skipped; returns the instance"""
+        if instance is None:
+            return None
+        state = inspect(instance)
+        values = {
+            attr.key: state.dict[attr.key]
+            for attr in state.mapper.column_attrs
+            if attr.key in state.dict
+        }
+        self.set(entity_key(instance.__tablename__, instance.id), values)
+        return instance
+
+    def get(self, key):
+        """get"""
+        return self.backend.get(key) if self.enabled() else None
+
+    def set(self, key, value):
+        """set"""
+        if not self.enabled():
+            return
+        # реплика может ещё не догнать свежую запись: такое значение не кэшируем
+        table = key.split(":", 1)[0]
+        lagging = DB_REPLICA_URLS and table_versions.changed_within(
+            ENTITY_TABLES.get(table, (table,)), DB_PRIMARY_PIN_SECONDS
+        )
+        if not lagging:
+            self.backend.set(key, value)
+
+    def invalidate(self, keys):
+        """invalidate"""
+        self.backend.delete(keys)
+
+    def invalidate_tables(self, tables):
+        """drops every key of the namespaces depending on the tables"""
+        namespaces = {
+            namespace
+            for table in tables
+            for namespace in ENTITY_NAMESPACES.get(table, ())
+        }
+        if namespaces:
+            self.backend.delete_prefix(entity_key(name, "") for name in namespaces)
+
+    def clear(self):
+        """clear"""
+        self.backend.clear()
+
+    def stats(self) -> dict:
+        """stats"""
+        return self.backend.stats()
+
+
+class BusState:
+    """whether the invalidation bus runs in this process, so commits of the
+    other workers reach its caches"""
+
+    def __init__(self):
+        self.attached = False
+
+    def attach(self):
+        """attach"""
+        self.attached = True
+
+    def detach(self):
+        """detach"""
+        self.attached = False
+
+
+# auto - кэш страниц и ETag работают, пока воркер подключён к шине инвалидации:
+# без неё версии таблиц других воркеров не растут от его коммитов и они отдают
+# устаревшие страницы; on - для одного воркера без шины; off - выключен
+PAGE_CACHE = os.getenv("PAGE_CACHE", "auto")
+PAGE_CACHE_SIZE = 1000
+# предел устаревания страниц и справочников, если сообщение шины потерялось
+PAGE_CACHE_TTL = float(os.getenv("PAGE_CACHE_TTL", "60"))
+
+lookup_cache = TableCache(ttl=PAGE_CACHE_TTL)
+page_cache = TableCache(max_size=PAGE_CACHE_SIZE, ttl=PAGE_CACHE_TTL)
+table_versions = TableVersions()
+bus_state = BusState()
+entity_cache = EntityCache(LocalBackend(ENTITY_CACHE_SIZE, ENTITY_CACHE_TTL))
+
+
+def cached_event(db, event_id):
+    """event with its counters by id, from the entity cache or the database"""
+    db_event = entity_cache.get_entity(models.Event, event_id)
+    if db_event is None:
+        db_event = entity_cache.store_entity(
+            db.scalars(queries.event_query(event_id)).first()
+        )
+    return db_event
+
+
+def cached_visitor(db, visitor_id):
+    """visitor with registration_count by id"""
+    db_visitor = entity_cache.get_entity(models.Visitor, visitor_id)
+    if db_visitor is None:
+        db_visitor = entity_cache.store_entity(
+            db.scalars(queries.visitor_query(visitor_id)).first()
+        )
+    return db_visitor
+
+
+def cached_registration_filters(db):
+    """events and visitors that have registrations, for the filter dropdowns"""
+
+    def load():
+        return queries.registration_filters(
+            db.execute(queries.filter_events_query()).all(),
+            db.execute(queries.filter_visitors_query()).all(),
+        )
+
+    return lookup_cache.get_or_load(
+        queries.REGISTRATION_FILTERS_KEY, queries.REGISTRATION_FILTERS_TABLES, load
+    )
+
+
+def cached_visitor_events_count(db, visitor_id):
+    """distinct events of a visitor"""
+    key = entity_key("visitor_events", visitor_id)
+    events_count = entity_cache.get(key)
+    if events_count is None:
+        events_count = db.scalar(queries.visitor_events_count_query(visitor_id))
+        entity_cache.set(key, events_count)
+    return events_count
+
+
+def _page_key(request):
+    """_page_key"""
+    return f"{request.url.path}?{request.url.query}"
+
+
+def _etag(stamp):
+    """_etag"""
+    return f'"{stamp}"'
+
+
+def _page_headers(stamp):
+    """_page_headers"""
+    return {"ETag": _etag(stamp), "Cache-Control": "no-cache"}
+
+
+def pages_cacheable() -> bool:
+    """whether commits of the other workers reach table_versions"""
+    return PAGE_CACHE == "on" or (PAGE_CACHE == "auto" and bus_state.attached)
+
+
+def cached_page(request, tables):
+    """304 or the cached HTML when the tables did not change since the render;
+    returns (response or None, stamp to pass to store_page), the stamp is None
+    when pages are not cached"""
+    if not pages_cacheable():
+        return None, None
+    stamp = table_versions.stamp(tables)
+    if_none_match = request.headers.get("if-none-match", "")
+    if _etag(stamp) in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=304, headers=_page_headers(stamp)), stamp
+    cached = page_cache.get(_page_key(request))
+    if cached is not None and cached[0] == stamp:
+        return HTMLResponse(cached[1], headers=_page_headers(stamp)), stamp
+    return None, stamp
+
+
+def store_page(request, tables, stamp, response):
+    """store_page"""
+    if stamp is None:
+        return response
+    # реплика может ещё не догнать свежую запись: такой рендер не кэшируем
+    lagging = DB_REPLICA_URLS and table_versions.changed_within(
+        tables, DB_PRIMARY_PIN_SECONDS
+    )
+    if response.status_code == 200 and not lagging:
+        page_cache.set(_page_key(request), tables, (stamp, response.body))
+        response.headers.update(_page_headers(stamp))
+    return response
+
+
+def _changed_tables(session):
+    """_changed_tables"""
+    return session.info.setdefault(CHANGED_TABLES, set())
+
+
+@event.listens_for(Session, "after_flush")
+def _track_flush(session, _flush_context):
+    """_track_flush"""
+    changed = _changed_tables(session)
+    for instance in (*session.new, *session.dirty, *session.deleted):
+        table = getattr(instance, "__tablename__", None)
+        if table:
+            changed.add(table)
+
+
+def _changed_entities(session):
+    """_changed_entities"""
+    return session.info.setdefault(CHANGED_ENTITIES, set())
+
+
+def _stale_keys(target):
+    """entity cache keys a flushed row makes stale, including the old event and
+    visitor of a moved registration"""
+    state = inspect(target)
+    keys = {entity_key(target.__tablename__, target.id)}
+    if isinstance(target, models.Registration):
+        for column, namespaces in (
+            ("event_id", ("events",)),
+            ("visitor_id", ("visitors", "visitor_events")),
+        ):
+            history = state.attrs[column].history
+            for value in (*history.unchanged, *history.added, *history.deleted):
+                keys.update(entity_key(namespace, value) for namespace in namespaces)
+    return keys
+
+
+@event.listens_for(Base, "after_insert", propagate=True)
+@event.listens_for(Base, "after_update", propagate=True)
+@event.listens_for(Base, "after_delete", propagate=True)
+def _track_entity(_mapper, _connection, target):
+    """_track_entity"""
+    session = inspect(target).session
+    if session is not None and target.__tablename__ in ENTITY_NAMESPACES:
+        _changed_entities(session).update(_stale_keys(target))
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _track_statement(orm_execute_state):
+    """_track_statement"""
+    if orm_execute_state.is_insert or orm_execute_state.is_update or (
+        orm_execute_state.is_delete
+    ):
+        table = getattr(orm_execute_state.statement, "table", None)
+        if table is not None:
+            session = orm_execute_state.session
+            _changed_tables(session).add(table.name)
+            rows = orm_execute_state.execution_options.get(models.CHANGED_ROWS)
+            if rows is None:
+                session.info.setdefault(BULK_TABLES, set()).add(table.name)
+            else:
+                _changed_entities(session).update(
+                    entity_key(namespace, entity_id)
+                    for namespace, ids in rows.items()
+                    for entity_id in ids
+                )
+
+
+# получают изменения каждого коммита этого процесса, например шина инвалидации
+change_listeners = []
+
+
+def apply_change(tables=(), keys=(), bulk=()):
+    """drops cached values made stale by a commit of this or another worker"""
+    if tables:
+        table_versions.bump(tables)
+        lookup_cache.invalidate(tables)
+        page_cache.invalidate(tables)
+    if keys:
+        entity_cache.invalidate(keys)
+    if bulk:
+        entity_cache.invalidate_tables(bulk)
+
+
+def clear_all():
+    """forgets every cached value, e.g. when invalidations may have been missed"""
+    lookup_cache.clear()
+    page_cache.clear()
+    entity_cache.clear()
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_on_commit(session):
+    """_invalidate_on_commit"""
+    change = {
+        "tables": sorted(session.info.pop(CHANGED_TABLES, ())),
+        "keys": sorted(session.info.pop(CHANGED_ENTITIES, ())),
+        "bulk": sorted(session.info.pop(BULK_TABLES, ())),
+    }
+    if any(change.values()):
+        apply_change(**change)
+        for listener in change_listeners:
+            listener(change)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_on_rollback(session):
+    """_forget_on_rollback"""
+    for key in (CHANGED_TABLES, CHANGED_ENTITIES, BULK_TABLES):
+        session.info.pop(key, None)
@@ -0,0 +1,131 @@
+"""cli"""
+import argparse
+
+from . import bus, idempotency, importer, models, reconcile, services, templating
+from .database import SessionLocal
+
+
+def reconcile_counters(args):
+    """reconcile_counters"""
+    with SessionLocal() as db:
+        updated = models.rebuild_event_counters(db, args.event_id)
+        db.commit()
+    print(f"Пересчитаны счётчики мероприятий: {updated}")
+
+
+def roll_over_events(args):
+    """roll_over_events"""
+    with SessionLocal() as db:
+        moved = services.roll_over_events(db, batch_size=args.batch_size)
+    print(f"Обновлены статусы мероприятий: {moved}")
+
+
+def import_csv(args):
+    """import_csv"""
+    load = importer.import_visitors if args.kind == "visitors" else importer.import_events
+    with open(args.path, encoding="utf-8-sig", newline="") as stream:
+        with SessionLocal() as db:
+            report = load(db, importer.read_csv(stream), args.chunk_size)
+    for error in report.as_dict()["errors"]:
+        print(f"строка {error['row']}: {error['error']}")
+    print(f"Загружено: {report.inserted}, ошибок: {len(report.errors)}")
+
+
+def reconcile_payments(args):
+    """reconcile_payments"""
+    with open(args.path, encoding="utf-8-sig", newline="") as stream:
+        with SessionLocal() as db:
+            report = reconcile.reconcile_payments(
+                db, importer.read_csv(stream), args.chunk_size
+            )
+    for mismatch in report.as_dict()["mismatches"]:
+        print(
+            f"строка {mismatch['row']} ({mismatch['reference']}, "
+            f"{mismatch['amount']}): {mismatch['error']}"
+        )
+    print(f"Проведено: {report.applied}, расхождений: {len(report.mismatches)}")
+
+
+def purge_idempotency_keys(args):
+    """purge_idempotency_keys"""
+    with SessionLocal() as db:
+        deleted = idempotency.purge_expired(db, batch_size=args.batch_size)
+    print(f"Удалено просроченных ключей идемпотентности: {deleted}")
+
+
+def compile_templates(_args):
+    """compile_templates"""
+    warmed = templating.warm_templates()
+    print(
+        f"Скомпилировано шаблонов: {warmed['templates']} "
+        f"за {warmed['seconds'] * 1000:.1f} мс в {templating.TEMPLATE_CACHE_DIR}"
+    )
+
+
+def main(argv=None):
+    """main"""
+    parser = argparse.ArgumentParser(prog="python -m app.cli")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    counters = commands.add_parser(
+        "reconcile-counters", help="пересчитать счётчики мероприятий с нуля"
+    )
+    counters.add_argument(
+        "--event-id",
+        type=int,
+        action="append",
+        help="только указанные мероприятия (можно повторять)",
+    )
+    counters.set_defaults(handler=reconcile_counters)
+
+    roll_over = commands.add_parser(
+        "roll-over-events",
+        help="перевести начавшиеся и закончившиеся мероприятия в новый статус",
+    )
+    roll_over.add_argument(
+        "--batch-size", type=int, default=services.ROLL_OVER_BATCH_SIZE
+    )
+    roll_over.set_defaults(handler=roll_over_events)
+
+    for kind, title in (("visitors", "посетителей"), ("events", "мероприятия")):
+        load = commands.add_parser(f"import-{kind}", help=f"загрузить {title} из CSV")
+        load.add_argument("path")
+        load.add_argument("--chunk-size", type=int, default=importer.IMPORT_CHUNK_SIZE)
+        load.set_defaults(handler=import_csv, kind=kind)
+
+    payments = commands.add_parser(
+        "reconcile-payments", help="провести оплаты и возвраты из банковской выписки"
+    )
+    payments.add_argument("path")
+    payments.add_argument(
+        "--chunk-size", type=int, default=importer.IMPORT_CHUNK_SIZE
+    )
+    payments.set_defaults(handler=reconcile_payments)
+
+    purge = commands.add_parser(
+        "purge-idempotency-keys", help="удалить просроченные ключи идемпотентности"
+    )
+    purge.add_argument(
+        "--batch-size", type=int, default=idempotency.PURGE_BATCH_SIZE
+    )
+    purge.set_defaults(handler=purge_idempotency_keys)
+
+    compile_parser = commands.add_parser(
+        "compile-templates", help="заполнить кэш байткода шаблонов при сборке"
+    )
+    compile_parser.set_defaults(handler=compile_templates)
+
+    args = parser.parse_args(argv)
+    # изменения команды доходят до кэшей запущенных воркеров
+    invalidation_bus = bus.configured_bus()
+    if invalidation_bus is not None:
+        invalidation_bus.start()
+    try:
+        args.handler(args)
+    finally:
+        if invalidation_bus is not None:
+            invalidation_bus.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,21 +1,327 @@
 """database"""
+import math
 import os
+import time
+from itertools import count
+from threading import Lock
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, exc, make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
 from dotenv import load_dotenv
+from starlette.requests import Request
 
 load_dotenv()
 
 SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL")
+# запрещает ленивую загрузку связей в запросах страниц, чтобы N+1 падали в тестах
+STRICT_LOADING = os.getenv("STRICT_LOADING", "") == "1"
+# sync - обработчики в пуле потоков, async - AsyncSession и async def страницы
+DB_MODE = os.getenv("DB_MODE", "sync")
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+}
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))
+# проверка соединения - лишний запрос при каждой выдаче из пула, по умолчанию выключена
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "0") == "1"
+# session - собственный пул соединений,
+# transaction - за pgbouncer в режиме transaction pooling: без пула и prepared statements
+DB_POOLER_MODE = os.getenv("DB_POOLER_MODE", "session")
+# реплики для страниц чтения через запятую, пусто - всё читается с primary
+DB_REPLICA_URLS = [
+    url.strip() for url in os.getenv("DB_REPLICA_URLS", "").split(",") if url.strip()
+]
+# сколько секунд не обращаться к реплике после ошибки соединения
+DB_REPLICA_RETRY = float(os.getenv("DB_REPLICA_RETRY", "30"))
+# сколько секунд после записи клиент читает с primary (read-your-writes)
+DB_PRIMARY_PIN_SECONDS = float(os.getenv("DB_PRIMARY_PIN_SECONDS", "5"))
+PRIMARY_PIN_COOKIE = "db_primary_until"
+
+
+class PoolStats:  # pylint: disable=R0902
+    """connection pool counters"""
+
+    def __init__(self):
+        self.pool = None
+        self._lock = Lock()
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.timeouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def count(self, name):
+        """count"""
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def observe_wait(self, seconds, timed_out=False):
+        """observe_wait"""
+        with self._lock:
+            self.waits += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            if timed_out:
+                self.timeouts += 1
+
+    def as_dict(self):
+        """as_dict"""
+        pool = self.pool
+        with self._lock:
+            return {
+                "pool": type(pool).__name__ if pool is not None else None,
+                "size": pool.size() if hasattr(pool, "size") else None,
+                "checked_out": (
+                    pool.checkedout() if hasattr(pool, "checkedout") else None
+                ),
+                "overflow": pool.overflow() if hasattr(pool, "overflow") else None,
+                "connects": self.connects,
+                "checkouts": self.checkouts,
+                "checkins": self.checkins,
+                "timeouts": self.timeouts,
+                "waits": self.waits,
+                "wait_seconds": self.wait_seconds,
+                "max_wait_seconds": self.max_wait_seconds,
+            }
+
+
+POOL_STATS = {}
+
+
+class _TimedCheckout:  # pylint: disable=E1101,R0903
+    """measures how long a checkout waits for a free connection"""
+
+    stats = None
+
+    def _exhausted(self):
+        """no idle connection and no room for overflow: the checkout will block"""
+        return self.checkedin() == 0 and -1 < self._max_overflow <= self.overflow()
+
+    def _do_get(self):
+        # checkout со свободным соединением ожиданием не считается
+        blocked = self.stats is not None and self._exhausted()
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except exc.TimeoutError:
+            if blocked:
+                self.stats.observe_wait(time.perf_counter() - started, timed_out=True)
+            raise
+        if blocked:
+            self.stats.observe_wait(time.perf_counter() - started)
+        return connection
+
+    def recreate(self):
+        """recreate"""
+        pool = super().recreate()
+        pool.stats = self.stats
+        if self.stats is not None:
+            self.stats.pool = pool
+        return pool
+
+
+class InstrumentedQueuePool(_TimedCheckout, QueuePool):
+    """QueuePool with checkout wait metrics"""
+
+
+class InstrumentedAsyncQueuePool(_TimedCheckout, AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool with checkout wait metrics"""
+
+
+def engine_options(url, is_async=False):
+    """create_engine arguments for the configured pool mode"""
+    if DB_POOLER_MODE == "transaction":
+        options = {"poolclass": NullPool}
+        if is_async and make_url(url).get_backend_name() == "postgresql":
+            # pgbouncer не сохраняет prepared statements между транзакциями
+            options["connect_args"] = {
+                "statement_cache_size": 0,
+                "prepared_statement_cache_size": 0,
+            }
+        return options
+    return {
+        "poolclass": InstrumentedAsyncQueuePool if is_async else InstrumentedQueuePool,
+        "pool_size": DB_POOL_SIZE,
+        "max_overflow": DB_MAX_OVERFLOW,
+        "pool_timeout": DB_POOL_TIMEOUT,
+        "pool_recycle": DB_POOL_RECYCLE,
+        "pool_pre_ping": DB_POOL_PRE_PING,
+    }
+
+
+def instrument_engine(db_engine, name):
+    """instrument_engine"""
+    sync_engine = getattr(db_engine, "sync_engine", db_engine)
+    stats = PoolStats()
+    stats.pool = sync_engine.pool
+    sync_engine.pool.stats = stats
+    POOL_STATS[name] = stats
+    event.listen(sync_engine, "connect", lambda *_: stats.count("connects"))
+    event.listen(sync_engine, "checkout", lambda *_: stats.count("checkouts"))
+    event.listen(sync_engine, "checkin", lambda *_: stats.count("checkins"))
+    return db_engine
+
+
+def pool_stats():
+    """pool_stats"""
+    return {name: stats.as_dict() for name, stats in POOL_STATS.items()}
+
+
+engine = instrument_engine(
+    create_engine(SQLALCHEMY_DATABASE_URL, **engine_options(SQLALCHEMY_DATABASE_URL)),
+    "primary",
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+def async_database_url(url):
+    """async_database_url"""
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))
+
+
+async_engine = (
+    instrument_engine(
+        create_async_engine(
+            async_database_url(SQLALCHEMY_DATABASE_URL),
+            **engine_options(SQLALCHEMY_DATABASE_URL, is_async=True),
+        ),
+        "async",
+    )
+    if DB_MODE == "async"
+    else None
+)
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
+
 Base = declarative_base()
 
 
+class ReplicaSet:
+    """round-robin over replica engines, skipping ones that failed recently"""
+
+    def __init__(self, engines, retry_after=DB_REPLICA_RETRY):
+        self.engines = list(engines)
+        self.retry_after = retry_after
+        self._turn = count()
+        self._down_until = {}
+        self._lock = Lock()
+
+    def candidates(self):
+        """healthy replicas, starting from the next one in turn"""
+        if not self.engines:
+            return []
+        with self._lock:
+            start = next(self._turn) % len(self.engines)
+            now = time.monotonic()
+            rotated = self.engines[start:] + self.engines[:start]
+            return [e for e in rotated if self._down_until.get(e, 0) <= now]
+
+    def mark_down(self, replica):
+        """mark_down"""
+        with self._lock:
+            self._down_until[replica] = time.monotonic() + self.retry_after
+
+    def session(self):
+        """session on the first replica that connects, primary otherwise"""
+        for replica in self.candidates():
+            db = SessionLocal(bind=replica)
+            try:
+                db.connection()
+                return db
+            except exc.DBAPIError:
+                db.close()
+                self.mark_down(replica)
+        return SessionLocal()
+
+    async def async_session(self):
+        """async_session"""
+        for replica in self.candidates():
+            db = AsyncSessionLocal(bind=replica)
+            try:
+                await db.connection()
+                return db
+            except exc.DBAPIError:
+                await db.close()
+                self.mark_down(replica)
+        return AsyncSessionLocal()
+
+
+replicas = ReplicaSet(
+    instrument_engine(create_engine(url, **engine_options(url)), f"replica{number}")
+    for number, url in enumerate(DB_REPLICA_URLS, start=1)
+)
+async_replicas = ReplicaSet(
+    instrument_engine(
+        create_async_engine(
+            async_database_url(url), **engine_options(url, is_async=True)
+        ),
+        f"async_replica{number}",
+    )
+    for number, url in enumerate(DB_REPLICA_URLS if DB_MODE == "async" else [], start=1)
+)
+
+
+def primary_pinned(request: Request) -> bool:
+    """primary_pinned"""
+    try:
+        return float(request.cookies.get(PRIMARY_PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+async def pin_primary_middleware(request, call_next):
+    """after a successful write the client reads from primary for a short
+    window, so the page it is redirected to already shows the change"""
+    response = await call_next(request)
+    if (
+        replicas.engines
+        and request.method not in ("GET", "HEAD", "OPTIONS")
+        and response.status_code < 400
+    ):
+        response.set_cookie(
+            PRIMARY_PIN_COOKIE,
+            str(time.time() + DB_PRIMARY_PIN_SECONDS),
+            max_age=math.ceil(DB_PRIMARY_PIN_SECONDS),
+            httponly=True,
+            samesite="lax",
+        )
+    return response
+
+
+# SQLSTATE нарушения внешнего ключа в Postgres
+FOREIGN_KEY_VIOLATION = "23503"
+
+
+def foreign_key_violation(error: exc.IntegrityError) -> bool:
+    """the IntegrityError refers to a row that does not exist"""
+    code = getattr(error.orig, "pgcode", None)
+    if code is not None:
+        return code == FOREIGN_KEY_VIOLATION
+    return "FOREIGN KEY constraint failed" in str(error.orig)
+
+
+def unique_violation(error: exc.IntegrityError, name, columns) -> bool:
+    """the IntegrityError is a duplicate in the unique index name over columns
+    (table.column)"""
+    diag = getattr(error.orig, "diag", None)
+    if diag is not None:
+        return diag.constraint_name == name
+    # sqlite называет не индекс, а его колонки
+    return str(error.orig) == f"UNIQUE constraint failed: {', '.join(columns)}"
+
+
 def get_db():
     """get db"""
     db = SessionLocal()
@@ -23,3 +329,33 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+def get_read_db(request: Request):
+    """session for read-only pages: a replica unless the client just wrote"""
+    if replicas.engines and not primary_pinned(request):
+        db = replicas.session()
+    else:
+        db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_db():
+    """get async db"""
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+async def get_async_read_db(request: Request):
+    """async counterpart of get_read_db"""
+    if async_replicas.engines and not primary_pinned(request):
+        db = await async_replicas.async_session()
+    else:
+        db = AsyncSessionLocal()
+    try:
+        yield db
+    finally:
+        await db.close()
@@ -0,0 +1,51 @@
+"""export"""
+import csv
+import io
+import json
+from datetime import datetime
+
+from sqlalchemy import Select
+from sqlalchemy.orm import Session
+
+EXPORT_BATCH_SIZE = 1000
+EXPORT_FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson",
+}
+
+
+def _json_default(value):
+    """_json_default"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def stream_rows(db: Session, statement: Select, export_format: str):
+    """yields the export in chunks, reading rows through a server-side cursor"""
+    try:
+        result = db.execute(statement.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        columns = list(result.keys())
+        if export_format == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(columns)
+            yield buffer.getvalue()
+        for partition in result.partitions():
+            buffer = io.StringIO()
+            if export_format == "csv":
+                writer = csv.writer(buffer)
+                writer.writerows(partition)
+            else:
+                for row in partition:
+                    buffer.write(
+                        json.dumps(
+                            dict(zip(columns, row)),
+                            default=_json_default,
+                            ensure_ascii=False,
+                        )
+                    )
+                    buffer.write("\n")
+            yield buffer.getvalue()
+    finally:
+        db.close()
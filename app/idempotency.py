@@ -0,0 +1,109 @@
+"""idempotency"""
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from fastapi import HTTPException
+from sqlalchemy import delete, select
+from sqlalchemy.orm import Session
+from starlette.responses import Response
+
+from . import models
+
+# сколько секунд повтор с тем же ключом получает сохранённый ответ
+IDEMPOTENCY_TTL = int(os.getenv("IDEMPOTENCY_TTL", "86400"))
+PURGE_BATCH_SIZE = 1000
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+
+def fingerprint(method, path, payload) -> str:
+    """sha256 of the request, a key reused for another request is rejected"""
+    data = json.dumps([method, path, payload], sort_keys=True, default=str)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+def replay(db: Session, key, request_fingerprint, now=None) -> Optional[Response]:
+    """stored response for the key or None; an expired record is dropped in the
+    current transaction so the key can be stored again"""
+    if not key or len(key) > 255:
+        raise HTTPException(status_code=400, detail="Invalid Idempotency-Key")
+    now = now or datetime.now()
+    record = db.get(models.IdempotencyKey, key)
+    if record is None:
+        return None
+    if record.expires_at <= now:
+        db.delete(record)
+        db.flush()
+        return None
+    if record.fingerprint != request_fingerprint:
+        raise HTTPException(
+            status_code=422,
+            detail="Idempotency-Key was already used with another request",
+        )
+    headers = {REPLAYED_HEADER: "true"}
+    if record.location:
+        headers["Location"] = record.location
+    return Response(
+        content=record.body,
+        status_code=record.status_code,
+        headers=headers,
+        media_type="application/json" if record.body else None,
+    )
+
+
+def remember(db: Session, key, request_fingerprint, response: Response, now=None):
+    """stores the response in the transaction of the write, so it is kept only
+    if the write commits; a concurrent retry fails on the primary key"""
+    now = now or datetime.now()
+    db.add(
+        models.IdempotencyKey(
+            key=key,
+            fingerprint=request_fingerprint,
+            status_code=response.status_code,
+            body=response.body.decode() or None,
+            location=response.headers.get("location"),
+            expires_at=now + timedelta(seconds=IDEMPOTENCY_TTL),
+        )
+    )
+    db.flush()
+
+
+class IdempotentRequest:
+    """Idempotency-Key of one write request, every call is a no-op without a key"""
+
+    def __init__(self, key, method, path, payload):
+        self.key = key
+        self.fingerprint = fingerprint(method, path, payload)
+
+    def replay(self, db: Session) -> Optional[Response]:
+        """stored response for the key; called again after an IntegrityError
+        and rollback it finds the response of a concurrent request with the
+        same key that committed first"""
+        if self.key is None:
+            return None
+        return replay(db, self.key, self.fingerprint)
+
+    def remember(self, db: Session, response: Response):
+        """remember"""
+        if self.key is not None:
+            remember(db, self.key, self.fingerprint, response)
+
+
+def purge_expired(db: Session, now=None, batch_size=PURGE_BATCH_SIZE) -> int:
+    """deletes expired keys in batches, one commit per batch"""
+    keys = models.IdempotencyKey.__table__
+    now = now or datetime.now()
+    total = 0
+    while True:
+        expired = (
+            select(keys.c.key).where(keys.c.expires_at <= now).limit(batch_size)
+        )
+        deleted = db.execute(
+            delete(keys).where(keys.c.key.in_(expired))
+        ).rowcount
+        db.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total
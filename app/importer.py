@@ -0,0 +1,146 @@
+"""importer"""
+import csv
+from itertools import islice
+
+from pydantic import ValidationError
+from sqlalchemy import insert, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from . import models, schemas
+
+IMPORT_CHUNK_SIZE = 1000
+
+
+class ImportReport:
+    """result of a bulk import"""
+
+    def __init__(self):
+        self.inserted = 0
+        self.errors = []
+
+    def error(self, row, message):
+        """error"""
+        self.errors.append({"row": row, "error": message})
+
+    def as_dict(self):
+        """as_dict"""
+        return {
+            "inserted": self.inserted,
+            "errors": sorted(self.errors, key=lambda error: error["row"]),
+        }
+
+
+def read_csv(stream):
+    """yields (line number, row) with empty cells as None"""
+    reader = csv.DictReader(stream)
+    for row in reader:
+        yield reader.line_num, {
+            key.strip(): (value.strip() or None) if isinstance(value, str) else value
+            for key, value in row.items()
+            if key
+        }
+
+
+def chunked(rows, size):
+    """chunked"""
+    rows = iter(rows)
+    while chunk := list(islice(rows, size)):
+        yield chunk
+
+
+def validation_message(exc: ValidationError):
+    """validation_message"""
+    return "; ".join(
+        f"{'.'.join(str(part) for part in error['loc'])}: {error['msg']}"
+        for error in exc.errors()
+    )
+
+
+def validate(schema, chunk, report):
+    """validate"""
+    valid = []
+    for line, row in chunk:
+        try:
+            values = {key: value for key, value in row.items() if value is not None}
+            valid.append((line, schema(**values).model_dump()))
+        except ValidationError as exc:
+            report.error(line, validation_message(exc))
+    return valid
+
+
+def insert_rows(db: Session, model, rows, report):
+    """one multi-row insert, row by row under savepoints if it conflicts"""
+    if not rows:
+        return
+    try:
+        db.execute(insert(model), [values for _, values in rows])
+        db.commit()
+        report.inserted += len(rows)
+        return
+    except IntegrityError:
+        db.rollback()
+    for line, values in rows:
+        try:
+            with db.begin_nested():
+                db.execute(insert(model), [values])
+            report.inserted += 1
+        except IntegrityError as exc:
+            report.error(line, f"integrity error: {exc.orig}")
+    db.commit()
+
+
+def import_visitors(  # pylint: disable=R0914
+    db: Session, rows, chunk_size=IMPORT_CHUNK_SIZE
+):
+    """import_visitors"""
+    report = ImportReport()
+    seen = {"phone": set(), "email": set()}
+    for chunk in chunked(rows, chunk_size):
+        valid = validate(schemas.VisitorCreate, chunk, report)
+        phones = {values["phone"] for _, values in valid}
+        emails = {values["email"] for _, values in valid if values["email"]}
+        existing = {"phone": set(), "email": set()}
+        if valid:
+            for phone, email in db.execute(
+                select(models.Visitor.phone, models.Visitor.email).where(
+                    or_(
+                        models.Visitor.phone.in_(phones),
+                        models.Visitor.email.in_(emails),
+                    )
+                )
+            ):
+                existing["phone"].add(phone)
+                existing["email"].add(email)
+        unique = []
+        for line, values in valid:
+            duplicate = next(
+                (
+                    field
+                    for field in ("phone", "email")
+                    if values[field]
+                    and (values[field] in existing[field] or values[field] in seen[field])
+                ),
+                None,
+            )
+            if duplicate:
+                report.error(line, f"{duplicate} already exists: {values[duplicate]}")
+                continue
+            for field in ("phone", "email"):
+                if values[field]:
+                    seen[field].add(values[field])
+            unique.append((line, values))
+        insert_rows(db, models.Visitor, unique, report)
+    return report
+
+
+def import_events(db: Session, rows, chunk_size=IMPORT_CHUNK_SIZE):
+    """import_events"""
+    report = ImportReport()
+    for chunk in chunked(rows, chunk_size):
+        chunk = [
+            (line, {**row, "status": row.get("status") or "planning"})
+            for line, row in chunk
+        ]
+        insert_rows(db, models.Event, validate(schemas.EventCreate, chunk, report), report)
+    return report
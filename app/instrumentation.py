@@ -0,0 +1,96 @@
+"""instrumentation"""
+#pylint: disable=R0903
+import json
+import logging
+import re
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+QUERY_STARTED = "query_started"
+
+logger = logging.getLogger("app.requests")
+
+
+class QueryStats:
+    """statements and database time of one request"""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def server_timing(self, total_seconds) -> str:
+        """Server-Timing header value"""
+        return (
+            f'db;dur={self.seconds * 1000:.2f};desc="{self.count} queries", '
+            f"app;dur={total_seconds * 1000:.2f}"
+        )
+
+
+current_stats: ContextVar[Optional[QueryStats]] = ContextVar(
+    "current_stats", default=None
+)
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _query_started(conn, _cursor, _statement, _parameters, _context, _executemany):
+    """_query_started"""
+    conn.info[QUERY_STARTED] = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _query_finished(conn, _cursor, _statement, _parameters, _context, _executemany):
+    """_query_finished"""
+    started = conn.info.pop(QUERY_STARTED, None)
+    stats = current_stats.get()
+    if stats is None or started is None:
+        return
+    stats.count += 1
+    stats.seconds += time.perf_counter() - started
+
+
+async def query_timing_middleware(request, call_next):
+    """counts statements per request, answers with Server-Timing and logs a line"""
+    stats = QueryStats()
+    token = current_stats.set(stats)
+    started = time.perf_counter()
+    try:
+        response = await call_next(request)
+    finally:
+        current_stats.reset(token)
+    total = time.perf_counter() - started
+    response.headers["Server-Timing"] = stats.server_timing(total)
+    logger.info(
+        json.dumps(
+            {
+                "method": request.method,
+                "path": request.url.path,
+                "status": response.status_code,
+                "duration_ms": round(total * 1000, 2),
+                "queries": stats.count,
+                "db_ms": round(stats.seconds * 1000, 2),
+            }
+        )
+    )
+    return response
+
+
+def query_count(response) -> int:
+    """statement count from the Server-Timing header of a response"""
+    match = re.search(r'desc="(\d+) queries"', response.headers.get("server-timing", ""))
+    if match is None:
+        raise AssertionError("response has no Server-Timing db metric")
+    return int(match.group(1))
+
+
+def assert_max_queries(response, limit):
+    """fails when an endpoint issued more statements than allowed, e.g. after
+    an N+1 regression"""
+    count = query_count(response)
+    assert count <= limit, (
+        f"{response.request.method} {response.request.url} issued {count} queries, "
+        f"limit is {limit}"
+    )
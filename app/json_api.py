@@ -0,0 +1,137 @@
+"""json api"""
+#pylint: disable=R0913,R0917
+from fastapi import APIRouter, Depends, HTTPException, Query
+from pydantic import TypeAdapter
+from sqlalchemy.orm import Session
+from starlette.responses import Response
+
+from . import models, queries, schemas
+from .cache import cached_event, cached_visitor, cached_visitor_events_count
+from .database import get_read_db
+from .utils import Keyset, PAGE_SIZE, MAX_PAGE_SIZE
+
+json_api = APIRouter(
+    prefix="/api",
+    tags=["JSON API"],
+)
+
+# адаптеры собираются один раз: валидация и сериализация идут в pydantic-core
+EVENT_PAGE = TypeAdapter(schemas.EventPage)
+EVENT_DETAIL = TypeAdapter(schemas.EventDetail)
+VISITOR_PAGE = TypeAdapter(schemas.VisitorPage)
+VISITOR_DETAIL = TypeAdapter(schemas.VisitorDetail)
+REGISTRATION_PAGE = TypeAdapter(schemas.RegistrationPage)
+REGISTRATION = TypeAdapter(schemas.Registration)
+
+
+class PydanticJSONResponse(Response):
+    """response whose body is already serialized by a TypeAdapter"""
+    media_type = "application/json"
+
+
+def json_response(adapter: TypeAdapter, value) -> PydanticJSONResponse:
+    """validates ORM objects by attributes and dumps them straight to bytes"""
+    return PydanticJSONResponse(
+        adapter.dump_json(adapter.validate_python(value, from_attributes=True))
+    )
+
+
+def keyset_page(db: Session, keyset: Keyset, query) -> dict:
+    """keyset_page"""
+    items, next_cursor, prev_cursor = queries.keyset_page(db, keyset, query)
+    return {"items": items, "next_cursor": next_cursor, "prev_cursor": prev_cursor}
+
+
+@json_api.get("/events/", response_model=schemas.EventPage)
+def list_events(
+    db: Session = Depends(get_read_db),
+    visitor_id: int = Query(None),
+    sort_by: str = Query(None),
+    sort_order: int = Query(None),
+    search: str = Query(None),
+    status: str = Query(None),
+    after: str = Query(None),
+    before: str = Query(None),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    """list_events"""
+    query = queries.events_query(visitor_id, search, status)
+    rank = queries.search_rank(
+        queries.EVENT_SEARCH_COLUMNS, search, queries.dialect_name(db)
+    )
+    keyset = Keyset(models.Event, sort_by, sort_order, after, before, limit, rank)
+    return json_response(EVENT_PAGE, keyset_page(db, keyset, query))
+
+
+@json_api.get("/events/{event_id}", response_model=schemas.EventDetail)
+def get_event(event_id: int, db: Session = Depends(get_read_db)):
+    """get_event"""
+    db_event = cached_event(db, event_id)
+    if db_event is None:
+        raise HTTPException(status_code=404, detail="Event not found")
+    return json_response(EVENT_DETAIL, db_event)
+
+
+@json_api.get("/visitors/", response_model=schemas.VisitorPage)
+def list_visitors(
+    db: Session = Depends(get_read_db),
+    event_id: int = Query(None),
+    sort_by: str = Query(None),
+    sort_order: int = Query(None),
+    search: str = Query(None),
+    after: str = Query(None),
+    before: str = Query(None),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    """list_visitors"""
+    query = queries.visitors_query(event_id, search)
+    rank = queries.search_rank(
+        queries.VISITOR_SEARCH_COLUMNS, search, queries.dialect_name(db)
+    )
+    keyset = Keyset(models.Visitor, sort_by, sort_order, after, before, limit, rank)
+    return json_response(VISITOR_PAGE, keyset_page(db, keyset, query))
+
+
+@json_api.get("/visitors/{visitor_id}", response_model=schemas.VisitorDetail)
+def get_visitor(visitor_id: int, db: Session = Depends(get_read_db)):
+    """get_visitor"""
+    db_visitor = cached_visitor(db, visitor_id)
+    if db_visitor is None:
+        raise HTTPException(status_code=404, detail="Visitor not found")
+    events_count = cached_visitor_events_count(db, visitor_id)
+    visitor = schemas.Visitor.model_validate(db_visitor, from_attributes=True)
+    return json_response(
+        VISITOR_DETAIL,
+        {
+            **visitor.model_dump(),
+            "registration_count": db_visitor.registration_count,
+            "events_count": events_count,
+        },
+    )
+
+
+@json_api.get("/registrations/", response_model=schemas.RegistrationPage)
+def list_registrations(
+    db: Session = Depends(get_read_db),
+    event_id: int = Query(None),
+    visitor_id: int = Query(None),
+    sort_by: str = Query(None),
+    sort_order: int = Query(None),
+    status: str = Query(None),
+    after: str = Query(None),
+    before: str = Query(None),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+):
+    """list_registrations"""
+    query = queries.registration_rows_query(event_id, visitor_id, status)
+    keyset = Keyset(models.Registration, sort_by, sort_order, after, before, limit)
+    return json_response(REGISTRATION_PAGE, keyset_page(db, keyset, query))
+
+
+@json_api.get("/registrations/{registration_id}", response_model=schemas.Registration)
+def get_registration(registration_id: int, db: Session = Depends(get_read_db)):
+    """get_registration"""
+    db_registration = db.scalars(queries.registration_query(registration_id)).first()
+    if db_registration is None:
+        raise HTTPException(status_code=404, detail="Registration not found")
+    return json_response(REGISTRATION, db_registration)
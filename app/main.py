@@ -1,13 +1,54 @@
 """main"""
+import asyncio
+import logging
+import time
 import traceback
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request
 from fastapi.staticfiles import StaticFiles
 from starlette.responses import JSONResponse
 
+from . import bus, metrics, services
+from .async_routes import async_api
+from .cache import entity_cache
+from .database import DB_MODE, pin_primary_middleware, pool_stats
+from .instrumentation import query_timing_middleware
+from .json_api import json_api
 from .routes import api
+from .templating import warm_templates
 
-app = FastAPI()
+BOOT_STARTED = time.perf_counter()
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(_app: FastAPI):
+    """warms the templates, joins the invalidation bus when INVALIDATION_BUS
+    is set and starts the event status scheduler when ROLL_OVER_INTERVAL is set"""
+    warm_templates()
+    invalidation_bus = bus.configured_bus()
+    if invalidation_bus is not None:
+        invalidation_bus.start()
+    logger.info("worker ready in %.2f s", time.perf_counter() - BOOT_STARTED)
+    task = None
+    if services.ROLL_OVER_INTERVAL > 0:
+        task = asyncio.create_task(
+            services.roll_over_periodically(services.ROLL_OVER_INTERVAL)
+        )
+    yield
+    if task is not None:
+        task.cancel()
+    if invalidation_bus is not None:
+        invalidation_bus.stop()
+    metrics.mark_process_dead()
+
+
+app = FastAPI(lifespan=lifespan)
+# metrics внутри timing: видит счётчик запросов к базе текущего запроса
+app.middleware("http")(metrics.metrics_middleware)
+app.middleware("http")(query_timing_middleware)
+app.middleware("http")(pin_primary_middleware)
 
 
 @app.exception_handler(Exception)
@@ -28,6 +69,28 @@ async def internal_server_error_handler(_request: Request, exc: Exception):
     )
 
 
+@app.get("/pool/stats/")
+def get_pool_stats():
+    """connection pool counters of every engine"""
+    return pool_stats()
+
+
+@app.get("/cache/stats/")
+def get_cache_stats():
+    """hits, misses and size of the entity cache of this worker"""
+    return entity_cache.stats()
+
+
+@app.get("/metrics", include_in_schema=False)
+def get_metrics():
+    """Prometheus text exposition"""
+    return metrics.metrics_response()
+
+
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
+if DB_MODE == "async":
+    # async версии страниц регистрируются раньше и перекрывают sync маршруты
+    app.include_router(async_api)
+app.include_router(json_api)
 app.include_router(api)
@@ -0,0 +1,145 @@
+"""metrics"""
+import os
+import time
+from threading import Lock
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.responses import Response
+
+from .database import pool_stats
+from .instrumentation import current_stats
+
+# с PROMETHEUS_MULTIPROC_DIR значения пишутся в mmap файлы каталога и
+# /metrics любого воркера суммирует все процессы
+MULTIPROCESS = bool(os.getenv("PROMETHEUS_MULTIPROC_DIR"))
+
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "HTTP requests", ["method", "route", "status"]
+)
+HTTP_LATENCY = Histogram(
+    "http_request_duration_seconds",
+    "HTTP request latency",
+    ["method", "route"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+DB_QUERIES = Histogram(
+    "http_request_db_queries",
+    "SQL statements per request",
+    ["route"],
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100),
+)
+DB_TIME = Histogram(
+    "http_request_db_seconds",
+    "Database time per request",
+    ["route"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+)
+POOL_CHECKED_OUT = Gauge(
+    "db_pool_checked_out",
+    "Connections checked out of the pool",
+    ["engine"],
+    multiprocess_mode="livesum",
+)
+POOL_OVERFLOW = Gauge(
+    "db_pool_overflow",
+    "Connections opened above pool_size",
+    ["engine"],
+    multiprocess_mode="livesum",
+)
+POOL_WAIT_SECONDS = Counter(
+    "db_pool_wait_seconds_total", "Time spent waiting for a connection", ["engine"]
+)
+POOL_TIMEOUTS = Counter(
+    "db_pool_timeouts_total", "Checkouts that timed out", ["engine"]
+)
+REGISTRATIONS_CREATED = Counter(
+    "registrations_created_total", "Registrations created", ["source"]
+)
+REGISTRATION_STATUS_CHANGES = Counter(
+    "registration_status_changes_total",
+    "Registrations moved to paid or refunded",
+    ["status", "source"],
+)
+EVENT_STATUS_TRANSITIONS = Counter(
+    "event_status_transitions_total",
+    "Event status changes made by readiness checks and the scheduler",
+    ["status", "source"],
+)
+INVALIDATION_MESSAGES = Counter(
+    "cache_invalidation_messages_total",
+    "Cache invalidation messages exchanged with other workers",
+    ["direction"],
+)
+
+
+# значения счётчиков пула на момент прошлого сбора: в Counter идёт только прирост
+_pool_totals = {}
+_pool_totals_lock = Lock()
+
+
+def _increase(counter, name, total):
+    """adds to the counter what the pool total grew by since the last call"""
+    key = (counter, name)
+    with _pool_totals_lock:
+        previous = _pool_totals.get(key, 0)
+        _pool_totals[key] = total
+    # счётчик пула создан заново: весь его итог - прирост
+    delta = total - previous if total >= previous else total
+    if delta:
+        counter.labels(name).inc(delta)
+
+
+def observe_pools():
+    """copies the connection pool state of this process into gauges and the
+    growth of its totals into counters"""
+    for name, stats in pool_stats().items():
+        POOL_CHECKED_OUT.labels(name).set(stats["checked_out"] or 0)
+        POOL_OVERFLOW.labels(name).set(max(stats["overflow"] or 0, 0))
+        _increase(POOL_WAIT_SECONDS, name, stats["wait_seconds"])
+        _increase(POOL_TIMEOUTS, name, stats["timeouts"])
+
+
+def route_name(request):
+    """path template of the matched route, keeps label cardinality bounded"""
+    route = request.scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+
+async def metrics_middleware(request, call_next):
+    """request rate, latency and per-request database load per route"""
+    started = time.perf_counter()
+    response = await call_next(request)
+    route = route_name(request)
+    HTTP_REQUESTS.labels(request.method, route, response.status_code).inc()
+    HTTP_LATENCY.labels(request.method, route).observe(time.perf_counter() - started)
+    stats = current_stats.get()
+    if stats is not None:
+        DB_QUERIES.labels(route).observe(stats.count)
+        DB_TIME.labels(route).observe(stats.seconds)
+    observe_pools()
+    return response
+
+
+def metrics_response():
+    """text exposition of this process, or of every worker in multiprocess mode"""
+    observe_pools()
+    registry = REGISTRY
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
+
+def mark_process_dead():
+    """drops live gauges of this worker from the multiprocess directory"""
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,21 @@
+"""migration_utils"""
+# alembic.op проксирует операции текущей миграции, pylint их не видит
+# pylint: disable=no-member
+import sqlalchemy as sa
+from alembic import op
+
+
+def drop_invalid_index(name, table):
+    """drops an index left INVALID by an interrupted CREATE INDEX CONCURRENTLY,
+    which create_index(if_not_exists=True) would otherwise keep"""
+    invalid = op.get_bind().execute(
+        sa.text(
+            "SELECT 1 FROM pg_index "
+            "WHERE indexrelid = to_regclass(:name) AND NOT indisvalid"
+        ),
+        {"name": name},
+    ).first()
+    if invalid:
+        op.drop_index(
+            name, table_name=table, postgresql_concurrently=True, if_exists=True
+        )
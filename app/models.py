@@ -1,32 +1,59 @@
 """models"""
 #pylint: disable=R0903
 
-from datetime import datetime
 from typing import Callable
 
 from sqlalchemy import (
     Column,
+    Index,
     ForeignKey,
     Integer,
+    SmallInteger,
     String,
+    Text,
     DateTime,
     TIMESTAMP,
     func,
     event,
-    and_,
+    or_,
     select,
+    inspect,
+    update,
 )
 func: Callable
-from sqlalchemy.orm import relationship, Session
+from sqlalchemy.orm import column_property, relationship
 from sqlalchemy.sql.functions import coalesce
 
 from .database import Base
 
 
+def sort_indexes(table, *columns):
+    """(column, id) indexes serving keyset pages in both directions"""
+    return tuple(Index(f"ix_{table}_{column}_id", column, "id") for column in columns)
+
+
+def trigram_index(table, column):
+    """GIN trigram index for ILIKE search, plain index outside postgres"""
+    return Index(
+        f"ix_{table}_{column}_trgm",
+        column,
+        postgresql_using="gin",
+        postgresql_ops={column: "gin_trgm_ops"},
+    )
+
+
 class Event(Base):
     """event_model"""
 
     __tablename__ = "events"
+    __table_args__ = (
+        trigram_index("events", "title"),
+        trigram_index("events", "description"),
+        trigram_index("events", "location"),
+        Index("ix_events_status_start_at", "status", "start_at"),
+        Index("ix_events_status_end_at", "status", "end_at"),
+        *sort_indexes("events", "start_at", "end_at", "price", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     title = Column(String(255), index=True, nullable=False)
@@ -37,8 +64,13 @@ class Event(Base):
     end_at = Column(DateTime, nullable=False)
     price = Column(Integer, default=0, nullable=False)
     visitor_limit = Column(Integer, default=0)
+    registration_count = Column(Integer, default=0, server_default="0", nullable=False)
+    paid_count = Column(Integer, default=0, server_default="0", nullable=False)
+    reserved_count = Column(Integer, default=0, server_default="0", nullable=False)
+    total_income = Column(Integer, default=0, server_default="0", nullable=False)
+    expected_income = Column(Integer, default=0, server_default="0", nullable=False)
     created_at = Column(TIMESTAMP, server_default=func.now())
-    updated_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
     registrations = relationship(
         "Registration", back_populates="event", cascade="all, delete-orphan"
     )
@@ -48,6 +80,12 @@ class Visitor(Base):
     """visitor_model"""
 
     __tablename__ = "visitors"
+    __table_args__ = (
+        trigram_index("visitors", "first_name"),
+        trigram_index("visitors", "last_name"),
+        trigram_index("visitors", "email"),
+        *sort_indexes("visitors", "created_at"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     first_name = Column(String(255), nullable=False)
@@ -55,7 +93,7 @@ class Visitor(Base):
     phone = Column(String(20), unique=True, nullable=False)
     email = Column(String(255), unique=True)
     created_at = Column(TIMESTAMP, server_default=func.now())
-    updated_at = Column(TIMESTAMP, server_default=func.now())
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
     registrations = relationship(
         "Registration", back_populates="visitor", cascade="all, delete-orphan"
     )
@@ -65,6 +103,23 @@ class Registration(Base):
     """registration_model"""
 
     __tablename__ = "registrations"
+    __table_args__ = (
+        Index(
+            "ux_registrations_event_id_visitor_id",
+            "event_id",
+            "visitor_id",
+            unique=True,
+        ),
+        Index("ix_registrations_event_id_status", "event_id", "status"),
+        *sort_indexes(
+            "registrations",
+            "price",
+            "billed_amount",
+            "refund_amount",
+            "billed_at",
+            "refunded_at",
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     visitor_id = Column(
@@ -81,76 +136,183 @@ class Registration(Base):
     billed_at = Column(TIMESTAMP)
     refunded_at = Column(TIMESTAMP)
     created_at = Column(TIMESTAMP, server_default=func.now())
-    updated_at = Column(TIMESTAMP, server_default=func.now())
-
-
-def update_event_after_paid(_mapper, connection, target):
-    """update_event_after_paid"""
-    db = Session(bind=connection)
-    db_event = db.query(Event).filter(Event.id == target.event_id).first()
-    if (
-        target.status == "paid"
-        and db_event.visitor_limit is not None
-        and db_event.visitor_limit > 0
-    ):
-        registration_count = connection.execute(
-            select(func.count())
-            .select_from(Registration)
-            .where(
-                Registration.event_id == target.event_id, Registration.status == "paid"
-            )
-        ).scalar()
-        if registration_count >= db_event.visitor_limit:
-            db_event.status = "ready"
-    elif target.status == "refunded":
-        db_event.status = "planning"
-    db.commit()
-    db.refresh(db_event)
-
-
-def before_update_event_handler(_mapper, _connection, target):
-    """before_update_event_handler"""
-    if target.start_at > target.end_at:
-        target.status = "cancelled"
-    elif target.status != "cancelled":
-        if target.start_at <= datetime.now():
-            target.status = "active"
-        if target.end_at <= datetime.now():
-            target.status = "completed"
-
-
-def update_registrations_status(_mapper, connection, target):
-    """update_registrations_status"""
-    if target.status in ["active", "completed"]:
-        connection.execute(
-            Registration.__table__.update()
-            .where(
-                and_(
-                    Registration.event_id == target.id,
-                    Registration.billed_amount == coalesce(Registration.price, 0),
-                )
+    updated_at = Column(TIMESTAMP, server_default=func.now(), onupdate=func.now())
+
+
+class IdempotencyKey(Base):
+    """response of a write request, replayed to retries with the same
+    Idempotency-Key until expires_at"""
+
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (Index("ix_idempotency_keys_expires_at", "expires_at"),)
+
+    key = Column(String(255), primary_key=True)
+    # sha256 метода, пути и тела запроса
+    fingerprint = Column(String(64), nullable=False)
+    status_code = Column(SmallInteger, nullable=False)
+    body = Column(Text)
+    location = Column(String(255))
+    expires_at = Column(TIMESTAMP, nullable=False)
+
+
+Visitor.registration_count = column_property(
+    select(func.count(Registration.id))
+    .where(Registration.visitor_id == Visitor.id)
+    .correlate_except(Registration)
+    .scalar_subquery(),
+    deferred=True,
+)
+
+
+COUNTED_COLUMNS = ("status", "price", "billed_amount", "refund_amount")
+# execution option bulk UPDATE/INSERT: {"events": ids, ...} - строки, чьи
+# закэшированные значения он меняет; без него кэш сбрасывает всю таблицу
+CHANGED_ROWS = "changed_rows"
+# регистрации в этих статусах не занимают место на мероприятии
+RELEASED_STATUSES = ("refunded", "cancelled")
+
+
+class EventFullError(Exception):
+    """raised when a registration would exceed the event visitor_limit"""
+
+    def __init__(self, event_id):
+        super().__init__(f"Event {event_id} is full")
+        self.event_id = event_id
+
+
+def _amount(value):
+    """_amount"""
+    return int(value) if value not in (None, "") else 0
+
+
+def registration_counters(values):
+    """counter contribution of a single registration"""
+    return {
+        "registration_count": 1,
+        "paid_count": int(values.get("status") == "paid"),
+        "reserved_count": int(
+            "status" in values and values["status"] not in RELEASED_STATUSES
+        ),
+        "total_income": _amount(values.get("billed_amount"))
+        - _amount(values.get("refund_amount")),
+        "expected_income": _amount(values.get("price")),
+    }
+
+
+def adjust_event_counters(connection, event_id, deltas):
+    """adjust counters in one UPDATE; taking a seat is conditional on visitor_limit"""
+    events = Event.__table__
+    values = {name: events.c[name] + delta for name, delta in deltas.items() if delta}
+    if event_id is None or not values:
+        return
+    statement = (
+        update(events)
+        .where(events.c.id == event_id)
+        .values(values)
+        .execution_options(**{CHANGED_ROWS: {"events": [event_id]}})
+    )
+    reserved = deltas.get("reserved_count", 0)
+    if reserved > 0:
+        statement = statement.where(
+            or_(
+                events.c.visitor_limit.is_(None),
+                events.c.visitor_limit == 0,
+                events.c.reserved_count + reserved <= events.c.visitor_limit,
             )
-            .values(status="completed")
         )
-        connection.execute(
-            Registration.__table__.update()
-            .where(
-                and_(
-                    Registration.event_id == target.id,
-                    Registration.billed_amount < coalesce(Registration.price, 0),
-                )
-            )
-            .values(status="cancelled")
+    if connection.execute(statement).rowcount == 0 and reserved > 0:
+        raise EventFullError(event_id)
+
+
+def rebuild_event_counters(connection, event_ids=None):
+    """recompute event counters from registrations"""
+    events = Event.__table__
+    registrations = Registration.__table__
+    of_event = registrations.c.event_id == events.c.id
+
+    def total(expression):
+        return (
+            select(coalesce(func.sum(expression), 0)).where(of_event).scalar_subquery()
         )
-    elif target.status == "cancelled":
-        connection.execute(
-            Registration.__table__.update()
-            .where(Registration.event_id == target.id)
-            .values(status="cancelled")
+
+    statement = update(events).values(
+        registration_count=select(func.count())
+        .select_from(registrations)
+        .where(of_event)
+        .scalar_subquery(),
+        paid_count=select(func.count())
+        .select_from(registrations)
+        .where(of_event, registrations.c.status == "paid")
+        .scalar_subquery(),
+        reserved_count=select(func.count())
+        .select_from(registrations)
+        .where(of_event, registrations.c.status.notin_(RELEASED_STATUSES))
+        .scalar_subquery(),
+        total_income=total(
+            coalesce(registrations.c.billed_amount, 0)
+            - coalesce(registrations.c.refund_amount, 0)
+        ),
+        expected_income=total(coalesce(registrations.c.price, 0)),
+    )
+    if event_ids is not None:
+        statement = statement.where(events.c.id.in_(event_ids)).execution_options(
+            **{CHANGED_ROWS: {"events": event_ids}}
+        )
+    return connection.execute(statement).rowcount
+
+
+def count_inserted_registration(_mapper, connection, target):
+    """count_inserted_registration"""
+    values = {"status": "unpaid", **inspect(target).dict}
+    adjust_event_counters(connection, target.event_id, registration_counters(values))
+
+
+def count_updated_registration(_mapper, connection, target):
+    """count_updated_registration"""
+    state = inspect(target)
+    event_history = state.attrs.event_id.history
+    if event_history.has_changes():
+        rebuild_event_counters(
+            connection,
+            [
+                event_id
+                for event_id in (*event_history.deleted, *event_history.added)
+                if event_id is not None
+            ],
         )
+        return
+    old = {}
+    new = {}
+    for name in COUNTED_COLUMNS:
+        history = state.attrs[name].history
+        if not history.has_changes():
+            continue
+        if not history.deleted:
+            # прежнее значение не было загружено, пересчитываем целиком
+            rebuild_event_counters(connection, [target.event_id])
+            return
+        old[name] = history.deleted[0]
+        new[name] = history.added[0] if history.added else None
+    old_counters = registration_counters(old)
+    deltas = {
+        name: value - old_counters[name]
+        for name, value in registration_counters(new).items()
+    }
+    adjust_event_counters(connection, target.event_id, deltas)
+
+
+def count_deleted_registration(_mapper, connection, target):
+    """count_deleted_registration"""
+    values = inspect(target).dict
+    if "event_id" not in values:
+        return
+    if any(name not in values for name in COUNTED_COLUMNS):
+        rebuild_event_counters(connection, [values["event_id"]])
+        return
+    deltas = {name: -value for name, value in registration_counters(values).items()}
+    adjust_event_counters(connection, values["event_id"], deltas)
 
 
-event.listen(Registration, "after_update", update_event_after_paid)
-event.listen(Registration, "after_insert", update_event_after_paid)
-event.listen(Event, "before_update", before_update_event_handler)
-event.listen(Event, "after_update", update_registrations_status)
+event.listen(Registration, "after_insert", count_inserted_registration)
+event.listen(Registration, "after_update", count_updated_registration)
+event.listen(Registration, "after_delete", count_deleted_registration)
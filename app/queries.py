@@ -0,0 +1,203 @@
+"""queries"""
+from sqlalchemy import Float, Select, distinct, func, select
+from sqlalchemy.orm import joinedload, undefer
+
+from . import models
+from .utils import with_loaders
+
+
+EVENT_SEARCH_COLUMNS = (
+    models.Event.title,
+    models.Event.description,
+    models.Event.location,
+)
+VISITOR_SEARCH_COLUMNS = (
+    models.Visitor.first_name,
+    models.Visitor.last_name,
+    models.Visitor.email,
+)
+
+
+def dialect_name(db) -> str:
+    """dialect_name"""
+    return db.get_bind().dialect.name
+
+
+def search_filter(columns, search):
+    """ILIKE по колонкам; в postgres его обслуживают trigram индексы"""
+    condition = columns[0].ilike(f"%{search}%")
+    for column in columns[1:]:
+        condition = condition | column.ilike(f"%{search}%")
+    return condition
+
+
+def search_rank(columns, search, dialect):
+    """relevance of the best matching column, postgres only"""
+    if not search or dialect != "postgresql":
+        return None
+    return func.greatest(
+        *(func.word_similarity(search, column, type_=Float) for column in columns),
+        type_=Float,
+    ).label("rank")
+
+
+def events_query(visitor_id=None, search=None, status=None) -> Select:
+    """events_query"""
+    query = with_loaders(select(models.Event))
+    if visitor_id:
+        query = query.join(models.Event.registrations).filter(
+            models.Registration.visitor_id == int(visitor_id)
+        )
+    if search:
+        query = query.filter(search_filter(EVENT_SEARCH_COLUMNS, search))
+    if status:
+        query = query.filter(models.Event.status == status)
+    return query
+
+
+def event_query(event_id: int) -> Select:
+    """event_query"""
+    return with_loaders(select(models.Event)).filter(models.Event.id == event_id)
+
+
+def visitors_query(event_id=None, search=None) -> Select:
+    """visitors_query"""
+    query = with_loaders(select(models.Visitor))
+    if event_id:
+        query = query.join(models.Visitor.registrations).filter(
+            models.Registration.event_id == event_id
+        )
+    if search:
+        query = query.filter(search_filter(VISITOR_SEARCH_COLUMNS, search))
+    return query
+
+
+def visitor_query(visitor_id: int) -> Select:
+    """visitor_query"""
+    return with_loaders(
+        select(models.Visitor), undefer(models.Visitor.registration_count)
+    ).filter(models.Visitor.id == visitor_id)
+
+
+def visitor_events_count_query(visitor_id: int) -> Select:
+    """visitor_events_count_query"""
+    return select(func.count(distinct(models.Registration.event_id))).filter(
+        models.Registration.visitor_id == visitor_id
+    )
+
+
+def registrations_query(event_id=None, visitor_id=None, status=None) -> Select:
+    """registrations_query"""
+    query = with_loaders(
+        select(models.Registration),
+        joinedload(models.Registration.visitor),
+        joinedload(models.Registration.event),
+    )
+    return filter_registrations(query, event_id, visitor_id, status)
+
+
+def registration_rows_query(event_id=None, visitor_id=None, status=None) -> Select:
+    """registrations without related rows, for the JSON API"""
+    query = with_loaders(select(models.Registration))
+    return filter_registrations(query, event_id, visitor_id, status)
+
+
+def registration_query(registration_id: int) -> Select:
+    """registration_query"""
+    return with_loaders(select(models.Registration)).filter(
+        models.Registration.id == registration_id
+    )
+
+
+def filter_registrations(query, event_id=None, visitor_id=None, status=None):
+    """filters shared by the registrations page and export"""
+    if event_id:
+        query = query.filter(models.Registration.event_id == int(event_id))
+    if visitor_id:
+        query = query.filter(models.Registration.visitor_id == int(visitor_id))
+    if status:
+        query = query.filter(models.Registration.status == status)
+    return query
+
+
+def registrations_export_query(event_id=None, visitor_id=None, status=None) -> Select:
+    """registrations joined with visitor and event names"""
+    query = (
+        select(
+            models.Registration.id,
+            models.Registration.event_id,
+            models.Event.title.label("event_title"),
+            models.Registration.visitor_id,
+            models.Visitor.first_name,
+            models.Visitor.last_name,
+            models.Visitor.phone,
+            models.Visitor.email,
+            models.Registration.status,
+            models.Registration.price,
+            models.Registration.billed_amount,
+            models.Registration.refund_amount,
+            models.Registration.billed_at,
+            models.Registration.refunded_at,
+            models.Registration.created_at,
+        )
+        .join(models.Event, models.Registration.event_id == models.Event.id)
+        .join(models.Visitor, models.Registration.visitor_id == models.Visitor.id)
+        .order_by(models.Registration.id)
+    )
+    return filter_registrations(query, event_id, visitor_id, status)
+
+
+# таблицы, от которых зависят страницы; счётчики мероприятий меняются
+# вместе с регистрациями
+EVENT_PAGE_TABLES = (models.Event.__tablename__, models.Registration.__tablename__)
+VISITOR_PAGE_TABLES = (
+    models.Visitor.__tablename__,
+    models.Registration.__tablename__,
+)
+REGISTRATION_PAGE_TABLES = (
+    models.Event.__tablename__,
+    models.Visitor.__tablename__,
+    models.Registration.__tablename__,
+)
+
+REGISTRATION_FILTERS_KEY = "registration_filters"
+REGISTRATION_FILTERS_TABLES = (
+    models.Event.__tablename__,
+    models.Visitor.__tablename__,
+    models.Registration.__tablename__,
+)
+
+
+def filter_events_query() -> Select:
+    """events that have registrations"""
+    return (
+        select(models.Event.id, models.Event.title)
+        .filter(models.Event.registrations.any())
+        .order_by(models.Event.title, models.Event.id)
+    )
+
+
+def filter_visitors_query() -> Select:
+    """visitors that have registrations"""
+    return (
+        select(models.Visitor.id, models.Visitor.first_name, models.Visitor.last_name)
+        .filter(models.Visitor.registrations.any())
+        .order_by(models.Visitor.last_name, models.Visitor.first_name)
+    )
+
+
+def keyset_page(db, keyset, query):
+    """(rows, next_cursor, prev_cursor) of one keyset page; async routes call it
+    through AsyncSession.run_sync"""
+    return keyset.page(db.execute(keyset.apply(query)).all())
+
+
+def registration_filters(event_rows, visitor_rows):
+    """registration_filters"""
+    return (
+        dict(event_rows),
+        {
+            visitor_id: f"{first_name} {last_name}"
+            for visitor_id, first_name, last_name in visitor_rows
+        },
+    )
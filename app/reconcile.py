@@ -0,0 +1,170 @@
+"""reconcile"""
+from collections import defaultdict
+
+from sqlalchemy import or_, select, update
+from sqlalchemy.orm import Session
+
+from . import metrics, models, schemas, services
+from .importer import IMPORT_CHUNK_SIZE, chunked, validate
+
+
+class ReconcileReport:
+    """result of a payment reconciliation"""
+
+    def __init__(self):
+        self.applied = 0
+        self.mismatches = []
+
+    def error(self, row, message, record=None):
+        """error"""
+        record = record or {}
+        reference = record.get("registration_id") or record.get("phone")
+        self.mismatches.append(
+            {
+                "row": row,
+                "reference": None if reference is None else str(reference),
+                "amount": record.get("amount"),
+                "error": message,
+            }
+        )
+
+    def as_dict(self):
+        """as_dict"""
+        return {
+            "applied": self.applied,
+            "mismatches": sorted(self.mismatches, key=lambda mismatch: mismatch["row"]),
+        }
+
+
+def load_registrations(db: Session, records):
+    """current state of the registrations referenced by a chunk, locked until
+    the chunk commits so the bulk UPDATE writes over the state it was
+    checked against"""
+    ids = {record["registration_id"] for _, record in records}
+    phones = {
+        record["phone"] for _, record in records if not record["registration_id"]
+    }
+    by_id = {}
+    by_phone = defaultdict(list)
+    rows = db.execute(
+        select(
+            models.Registration.id,
+            models.Registration.event_id,
+            models.Registration.status,
+            models.Registration.price,
+            models.Registration.billed_amount,
+            models.Visitor.phone,
+        )
+        .join(models.Visitor, models.Registration.visitor_id == models.Visitor.id)
+        .where(
+            or_(
+                models.Registration.id.in_(ids - {None}),
+                models.Visitor.phone.in_(phones),
+            )
+        )
+        # строки блокируются по возрастанию id, как и у параллельной сверки
+        .order_by(models.Registration.id)
+        .with_for_update(of=models.Registration)
+    )
+    for row in rows:
+        state = row._asdict()
+        by_id[state["id"]] = state
+        by_phone[state["phone"]].append(state)
+    return by_id, by_phone
+
+
+def match(record, by_id, by_phone):
+    """registration a record pays or refunds, or the reason it matches none"""
+    if record["registration_id"]:
+        state = by_id.get(record["registration_id"])
+        return (state, None) if state else (None, "registration not found")
+    if record["amount"] > 0:
+        candidates = [
+            state
+            for state in by_phone[record["phone"]]
+            if state["status"] == "unpaid" and state["price"] == record["amount"]
+        ]
+    else:
+        candidates = [
+            state
+            for state in by_phone[record["phone"]]
+            if state["status"] == "paid"
+            and state["billed_amount"] == -record["amount"]
+        ]
+    if len(candidates) > 1:
+        return None, "several registrations match this phone and amount"
+    if not candidates:
+        return None, "no registration matches this phone and amount"
+    return candidates[0], None
+
+
+def apply(state, record):
+    """values to write for one record, or the reason it cannot be applied"""
+    amount = record["amount"]
+    if amount > 0:
+        if state["status"] != "unpaid":
+            return None, f"registration is already {state['status']}"
+        if amount != state["price"]:
+            return None, f"amount {amount} does not match price {state['price']}"
+        return {
+            "status": "paid",
+            "billed_amount": amount,
+            "billed_at": record["paid_at"],
+        }, None
+    if state["status"] != "paid":
+        return None, f"cannot refund a registration that is {state['status']}"
+    if -amount > (state["billed_amount"] or 0):
+        return None, f"refund {-amount} exceeds billed {state['billed_amount']}"
+    return {
+        "status": "refunded",
+        "refund_amount": -amount,
+        "refunded_at": record["paid_at"],
+    }, None
+
+
+def reconcile_payments(  # pylint: disable=R0914
+    db: Session, rows, chunk_size=IMPORT_CHUNK_SIZE
+):
+    """apply payments and refunds in chunked transactions with bulk UPDATEs"""
+    report = ReconcileReport()
+    for chunk in chunked(rows, chunk_size):
+        records = validate(schemas.PaymentRecord, chunk, report)
+        if not records:
+            continue
+        by_id, by_phone = load_registrations(db, records)
+        updates = {}
+        transitions = defaultdict(set)
+        applied = defaultdict(int)
+        for line, record in records:
+            state, message = match(record, by_id, by_phone)
+            values = None
+            if state is not None:
+                values, message = apply(state, record)
+            if message:
+                report.error(line, message, record)
+                continue
+            state.update(values)
+            updates.setdefault(state["id"], {"id": state["id"]}).update(values)
+            transitions[state["event_id"]].add(values["status"])
+            applied[values["status"]] += 1
+            report.applied += 1
+        if not updates:
+            # отпускаем блокировки строк, которые ничего не получили
+            db.rollback()
+            continue
+        # bulk UPDATE по первичному ключу, mapper события не срабатывают
+        db.execute(
+            update(models.Registration).execution_options(
+                **{models.CHANGED_ROWS: {"events": list(transitions)}}
+            ),
+            list(updates.values()),
+        )
+        models.rebuild_event_counters(db, list(transitions))
+        for event_id, statuses in transitions.items():
+            if "refunded" in statuses:
+                services.update_event_readiness(db, event_id, "refunded")
+            services.update_event_readiness(db, event_id, "paid")
+        db.commit()
+        for status, count in applied.items():
+            metrics.REGISTRATION_STATUS_CHANGES.labels(status, "reconcile").inc(count)
+    return report
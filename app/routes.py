@@ -1,37 +1,74 @@
 """routes"""
-#pylint: disable=R0913,R0917
+#pylint: disable=R0913,R0914,R0917
 from datetime import datetime
 from typing import Optional
 
-from fastapi import Depends, Request, HTTPException, Query, Form, APIRouter
+import io
+
+from fastapi import (
+    Depends,
+    Request,
+    HTTPException,
+    Query,
+    Form,
+    File,
+    Header,
+    UploadFile,
+    APIRouter,
+)
 from fastapi.responses import HTMLResponse
 from pydantic import EmailStr
-from sqlalchemy import func
-from sqlalchemy.orm import Session
-from starlette.responses import RedirectResponse
-from starlette.templating import Jinja2Templates
-
-from . import models, schemas
-from .database import get_db
+from sqlalchemy import or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, joinedload
+from starlette.responses import RedirectResponse, Response, StreamingResponse
+
+from . import (
+    export,
+    idempotency,
+    importer,
+    metrics,
+    models,
+    queries,
+    reconcile,
+    schemas,
+    services,
+)
+from .cache import (
+    cached_event,
+    cached_page,
+    cached_registration_filters,
+    cached_visitor,
+    cached_visitor_events_count,
+    store_page,
+)
+from .database import foreign_key_violation, get_db, get_read_db, unique_violation
+from .templating import templates
 from .schemas import (
     EventBase,
     VisitorBase,
     RegistrationBase,
     DeleteResponse,
+    ImportResponse,
+    ReconcileResponse,
+    RegistrationBatchResponse,
     VisitorUpdateResponse,
     EventUpdateResponse,
     RegistrationUpdateResponse,
 )
-from .utils import order_query, build_url_with_query, format_price, format_datetime_ru
+from .utils import (
+    Keyset,
+    PAGE_SIZE,
+    MAX_PAGE_SIZE,
+    page_links,
+    with_loaders,
+    build_url_with_query,
+)
 
 api = APIRouter(
     tags=["API"],
 )
 
-templates = Jinja2Templates(directory="templates")
-templates.env.filters["format_price"] = format_price
-templates.env.filters["format_datetime_ru"] = format_datetime_ru
-
 
 @api.get("/", response_class=HTMLResponse)
 def get_route(request: Request):
@@ -42,35 +79,35 @@ def get_route(request: Request):
 @api.get("/events/", response_class=HTMLResponse)
 def get_events(
     request: Request,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     visitor_id=Query(None),
     sort_by: str = Query(None),
     sort_order: int = Query(None),
     search: str = Query(None),
     status: str = Query(None),
+    after: str = Query(None),
+    before: str = Query(None),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
 ):
     """get_events"""
     if not (visitor_id == "" or visitor_id is None or visitor_id.isdigit()):
         raise HTTPException(status_code=400, detail="Invalid visitor id")
-    query = db.query(models.Event)
-    if visitor_id:
-        query = query.filter(models.Registration.visitor_id == visitor_id)
-    if search:
-        query = query.filter(
-            models.Event.title.ilike(f"%{search}%")
-            | models.Event.description.ilike(f"%{search}%")
-            | models.Event.location.ilike(f"%{search}%")
-        )
-    if status:
-        query = query.filter(models.Event.status == status)
-    query = order_query(models.Event, query, sort_by, sort_order)
-    events = query.all()
-    return templates.TemplateResponse(
+    cached, stamp = cached_page(request, queries.EVENT_PAGE_TABLES)
+    if cached is not None:
+        return cached
+    query = queries.events_query(visitor_id, search, status)
+    rank = queries.search_rank(
+        queries.EVENT_SEARCH_COLUMNS, search, queries.dialect_name(db)
+    )
+    keyset = Keyset(models.Event, sort_by, sort_order, after, before, limit, rank)
+    events, next_cursor, prev_cursor = queries.keyset_page(db, keyset, query)
+    response = templates.TemplateResponse(
         request,
         "event/index.html",
         {
             "request": request,
             "events": events,
+            **page_links(request, next_cursor, prev_cursor),
             "sort_by": sort_by,
             "sort_order": sort_order,
             "search": search,
@@ -78,49 +115,28 @@ def get_events(
             "status": status,
         },
     )
+    return store_page(request, queries.EVENT_PAGE_TABLES, stamp, response)
 
 
 @api.get("/events/{event_id}", response_model=schemas.Event)
-def read_event(event_id: int, request: Request, db: Session = Depends(get_db)):
+def read_event(event_id: int, request: Request, db: Session = Depends(get_read_db)):
     """read_event"""
-    db_event = db.query(models.Event).filter(models.Event.id == event_id).first()
+    cached, stamp = cached_page(request, queries.EVENT_PAGE_TABLES)
+    if cached is not None:
+        return cached
+    db_event = cached_event(db, event_id)
     if db_event is None:
         raise HTTPException(status_code=404, detail="Event not found")
-    visitors = (
-        db.query(models.Visitor)
-        .join(models.Registration)
-        .filter(models.Registration.event_id == event_id)
-        .all()
-    )
-    total_income = (
-        db.query(
-            func.sum(
-                func.coalesce(models.Registration.billed_amount, 0)
-                - func.coalesce(models.Registration.refund_amount, 0)
-            )
-        )
-        .filter(models.Registration.event_id == event_id)
-        .scalar()
-        or 0
-    )
-    expected_income = (
-        db.query(func.sum(func.coalesce(models.Registration.price, 0)))
-        .filter(models.Registration.event_id == event_id)
-        .scalar()
-        or 0
-    )
-    return templates.TemplateResponse(
+    response = templates.TemplateResponse(
         request,
         "event/view.html",
         {
             "request": request,
             "event": db_event,
-            "visitors": visitors,
-            "total_income": total_income,
-            "expected_income": expected_income,
             "build_url_with_query": build_url_with_query,
         },
     )
+    return store_page(request, queries.EVENT_PAGE_TABLES, stamp, response)
 
 
 @api.get(
@@ -143,7 +159,7 @@ def create_event_form(request: Request):
 @api.get("/events/{event_id}/update/", response_class=HTMLResponse)
 def update_event_form(event_id: int, request: Request, db: Session = Depends(get_db)):
     """update_event_form"""
-    db_event = db.query(models.Event).filter(models.Event.id == event_id).first()
+    db_event = cached_event(db, event_id)
     if db_event is None:
         raise HTTPException(status_code=404, detail="Event not found")
     return templates.TemplateResponse(
@@ -193,6 +209,18 @@ def create_event(
     return RedirectResponse(url=f"/events/{db_event.id}", status_code=303)
 
 
+@api.post(
+    "/events/import/",
+    response_model=ImportResponse,
+    description="Загрузить мероприятия из CSV",
+)
+def import_events(file: UploadFile = File(...), db: Session = Depends(get_db)):
+    """import_events"""
+    with io.TextIOWrapper(file.file, encoding="utf-8-sig", newline="") as stream:
+        report = importer.import_events(db, importer.read_csv(stream))
+    return {"status": "ok", "redirect_url": "/events/", **report.as_dict()}
+
+
 @api.put(
     "/events/{event_id}/update/",
     response_model=EventUpdateResponse,
@@ -207,7 +235,7 @@ def update_event(
         raise HTTPException(status_code=404, detail="Event not found")
     for key, value in event.model_dump().items():
         setattr(db_event, key, value)
-
+    services.apply_event_status(db, db_event)
     db.commit()
     db.refresh(db_event)
     return {
@@ -233,60 +261,60 @@ def delete_event(event_id: int, db: Session = Depends(get_db)):
 @api.get("/visitors/", response_class=HTMLResponse)
 def get_visitors(
     request: Request,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     event_id: int = Query(None),
     sort_by: str = Query(None),
     sort_order: int = Query(None),
     search: str = Query(None),
+    after: str = Query(None),
+    before: str = Query(None),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
 ):
     """get_visitors"""
-    query = db.query(models.Visitor)
-    if event_id:
-        query = query.filter(models.Registration.event_id == event_id)
-    if search:
-        query = query.filter(
-            models.Visitor.first_name.ilike(f"%{search}%")
-            | models.Visitor.last_name.ilike(f"%{search}%")
-            | models.Visitor.email.ilike(f"%{search}%")
-        )
-    query = order_query(models.Visitor, query, sort_by, sort_order)
-    visitors = query.all()
-    return templates.TemplateResponse(
+    cached, stamp = cached_page(request, queries.VISITOR_PAGE_TABLES)
+    if cached is not None:
+        return cached
+    query = queries.visitors_query(event_id, search)
+    rank = queries.search_rank(
+        queries.VISITOR_SEARCH_COLUMNS, search, queries.dialect_name(db)
+    )
+    keyset = Keyset(models.Visitor, sort_by, sort_order, after, before, limit, rank)
+    visitors, next_cursor, prev_cursor = queries.keyset_page(db, keyset, query)
+    response = templates.TemplateResponse(
         request,
         "visitor/index.html",
         {
             "request": request,
             "visitors": visitors,
+            **page_links(request, next_cursor, prev_cursor),
             "sort_by": sort_by,
             "sort_order": sort_order,
         },
     )
+    return store_page(request, queries.VISITOR_PAGE_TABLES, stamp, response)
 
 
 @api.get("/visitors/{visitor_id}", response_model=schemas.Visitor)
-def read_visitor(visitor_id: int, request: Request, db: Session = Depends(get_db)):
+def read_visitor(visitor_id: int, request: Request, db: Session = Depends(get_read_db)):
     """read_visitor"""
-    db_visitor = (
-        db.query(models.Visitor).filter(models.Visitor.id == visitor_id).first()
-    )
+    cached, stamp = cached_page(request, queries.VISITOR_PAGE_TABLES)
+    if cached is not None:
+        return cached
+    db_visitor = cached_visitor(db, visitor_id)
     if db_visitor is None:
         raise HTTPException(status_code=404, detail="Visitor not found")
-    events = (
-        db.query(models.Event)
-        .join(models.Registration)
-        .filter(models.Registration.visitor_id == visitor_id)
-        .all()
-    )
-    return templates.TemplateResponse(
+    events_count = cached_visitor_events_count(db, visitor_id)
+    response = templates.TemplateResponse(
         request,
         "visitor/view.html",
         {
             "request": request,
             "visitor": db_visitor,
-            "events": events,
+            "events_count": events_count,
             "build_url_with_query": build_url_with_query,
         },
     )
+    return store_page(request, queries.VISITOR_PAGE_TABLES, stamp, response)
 
 
 @api.get(
@@ -310,9 +338,7 @@ def update_visitor_form(
     visitor_id: int, request: Request, db: Session = Depends(get_db)
 ):
     """update_visitor_form"""
-    db_visitor = (
-        db.query(models.Visitor).filter(models.Visitor.id == visitor_id).first()
-    )
+    db_visitor = cached_visitor(db, visitor_id)
     if db_visitor is None:
         raise HTTPException(status_code=404, detail="Visitor not found")
     return templates.TemplateResponse(
@@ -351,6 +377,18 @@ def create_visitor(
     return RedirectResponse(url=f"/visitors/{db_visitor.id}", status_code=303)
 
 
+@api.post(
+    "/visitors/import/",
+    response_model=ImportResponse,
+    description="Загрузить посетителей из CSV",
+)
+def import_visitors(file: UploadFile = File(...), db: Session = Depends(get_db)):
+    """import_visitors"""
+    with io.TextIOWrapper(file.file, encoding="utf-8-sig", newline="") as stream:
+        report = importer.import_visitors(db, importer.read_csv(stream))
+    return {"status": "ok", "redirect_url": "/visitors/", **report.as_dict()}
+
+
 @api.put(
     "/visitors/{visitor_id}/update/",
     response_model=VisitorUpdateResponse,
@@ -393,41 +431,35 @@ def delete_visitor(visitor_id: int, db: Session = Depends(get_db)):
 @api.get("/registrations/", response_class=HTMLResponse)
 def get_registrations(
     request: Request,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     event_id=Query(None),
     visitor_id=Query(None),
     sort_by: str = Query(None),
     sort_order: int = Query(None),
     status: str = Query(None),
+    after: str = Query(None),
+    before: str = Query(None),
+    limit: int = Query(PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
 ):
     """get_registrations"""
     if not (event_id == "" or event_id is None or event_id.isdigit()):
         raise HTTPException(status_code=400, detail="Invalid event id")
     if not (visitor_id == "" or visitor_id is None or visitor_id.isdigit()):
         raise HTTPException(status_code=400, detail="Invalid visitor id")
-    query = db.query(models.Registration)
-    events = {}
-    visitors = {}
-    for registration in query.all():
-        events.setdefault(registration.event_id, registration.event.title)
-        visitors.setdefault(
-            registration.visitor_id,
-            f"{registration.visitor.first_name} {registration.visitor.last_name}",
-        )
-    if event_id:
-        query = query.filter(models.Registration.event_id == event_id)
-    if visitor_id:
-        query = query.filter(models.Registration.visitor_id == visitor_id)
-    if status:
-        query = query.filter(models.Event.status == status)
-    query = order_query(models.Registration, query, sort_by, sort_order)
-    registrations = query.all()
-    return templates.TemplateResponse(
+    cached, stamp = cached_page(request, queries.REGISTRATION_PAGE_TABLES)
+    if cached is not None:
+        return cached
+    query = queries.registrations_query(event_id, visitor_id, status)
+    events, visitors = cached_registration_filters(db)
+    keyset = Keyset(models.Registration, sort_by, sort_order, after, before, limit)
+    registrations, next_cursor, prev_cursor = queries.keyset_page(db, keyset, query)
+    response = templates.TemplateResponse(
         request,
         "registration/index.html",
         {
             "request": request,
             "registrations": registrations,
+            **page_links(request, next_cursor, prev_cursor),
             "sort_by": sort_by,
             "sort_order": sort_order,
             "statuses": schemas.REGISTRATION_STATUSES,
@@ -438,6 +470,36 @@ def get_registrations(
             "visitor_id": visitor_id,
         },
     )
+    return store_page(request, queries.REGISTRATION_PAGE_TABLES, stamp, response)
+
+
+@api.get(
+    "/registrations/export/",
+    response_class=StreamingResponse,
+    description="Выгрузка регистраций в CSV или JSONL",
+)
+def export_registrations(
+    db: Session = Depends(get_read_db),
+    event_id=Query(None),
+    visitor_id=Query(None),
+    status: str = Query(None),
+    export_format: str = Query("csv", alias="format", pattern="^(csv|jsonl)$"),
+):
+    """export_registrations"""
+    if not (event_id == "" or event_id is None or event_id.isdigit()):
+        raise HTTPException(status_code=400, detail="Invalid event id")
+    if not (visitor_id == "" or visitor_id is None or visitor_id.isdigit()):
+        raise HTTPException(status_code=400, detail="Invalid visitor id")
+    statement = queries.registrations_export_query(event_id, visitor_id, status)
+    return StreamingResponse(
+        export.stream_rows(db, statement, export_format),
+        media_type=export.EXPORT_FORMATS[export_format],
+        headers={
+            "Content-Disposition": (
+                f'attachment; filename="registrations.{export_format}"'
+            )
+        },
+    )
 
 
 @api.get(
@@ -450,6 +512,13 @@ def create_registration_form(request: Request, db: Session = Depends(get_db)):
     events = (
         db.query(models.Event)
         .filter(models.Event.status.notin_(["cancelled", "completed", "ready"]))
+        .filter(
+            or_(
+                models.Event.visitor_limit.is_(None),
+                models.Event.visitor_limit == 0,
+                models.Event.reserved_count < models.Event.visitor_limit,
+            )
+        )
         .all()
     )
     visitors = db.query(models.Visitor).all()
@@ -470,7 +539,11 @@ def update_registration_form(
 ):
     """update_registration_form"""
     db_registration = (
-        db.query(models.Registration)
+        with_loaders(
+            db.query(models.Registration),
+            joinedload(models.Registration.visitor),
+            joinedload(models.Registration.event),
+        )
         .filter(models.Registration.id == registration_id)
         .first()
     )
@@ -488,6 +561,24 @@ def update_registration_form(
     )
 
 
+def registration_conflict(error: IntegrityError) -> HTTPException:
+    """response to an IntegrityError raised by inserting a registration"""
+    if foreign_key_violation(error):
+        # мероприятие или посетителя удалили после проверки
+        return HTTPException(status_code=404, detail="Event or visitor not found")
+    if unique_violation(
+        error,
+        "ux_registrations_event_id_visitor_id",
+        ("registrations.event_id", "registrations.visitor_id"),
+    ):
+        return HTTPException(
+            status_code=400, detail="Registration with this params already exists"
+        )
+    return HTTPException(
+        status_code=400, detail="Registration changed concurrently, retry"
+    )
+
+
 @api.post(
     "/registrations/create/",
     response_model=RegistrationBase,
@@ -496,29 +587,26 @@ def update_registration_form(
 def create_registration(
     event_id: int = Form(...),
     visitor_id: int = Form(...),
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db),
 ):
-    """create_registration"""
-    db_visitor = (
-        db.query(models.Visitor).filter(models.Visitor.id == visitor_id).first()
+    """create_registration; a retry with the same Idempotency-Key gets the
+    stored response without registering again"""
+    idempotent = idempotency.IdempotentRequest(
+        idempotency_key,
+        "POST",
+        "/registrations/create/",
+        {"event_id": event_id, "visitor_id": visitor_id},
     )
-    if db_visitor is None:
+    replayed = idempotent.replay(db)
+    if replayed is not None:
+        return replayed
+    # цена и существование берутся из базы: кэш сущностей только для чтения
+    if db.get(models.Visitor, visitor_id) is None:
         raise HTTPException(status_code=404, detail="Visitor not found")
-    db_event = db.query(models.Event).filter(models.Event.id == event_id).first()
+    db_event = db.get(models.Event, event_id)
     if db_event is None:
         raise HTTPException(status_code=404, detail="Event not found")
-    registration = (
-        db.query(models.Registration)
-        .filter(
-            models.Registration.event_id == event_id,
-            models.Registration.visitor_id == visitor_id,
-        )
-        .first()
-    )
-    if registration is not None:
-        raise HTTPException(
-            status_code=400, detail="Registration with this params already exists"
-        )
     price = db_event.price
     status = "unpaid"
     if not price:
@@ -531,9 +619,72 @@ def create_registration(
     )
     db_registration = models.Registration(**registration_data.model_dump())
     db.add(db_registration)
-    db.commit()
-    db.refresh(db_registration)
-    return RedirectResponse(url="/registrations/", status_code=303)
+    response = RedirectResponse(url="/registrations/", status_code=303)
+    try:
+        db.flush()
+        services.update_event_readiness(db, event_id, db_registration.status)
+        idempotent.remember(db, response)
+        db.commit()
+    except IntegrityError as exc:
+        db.rollback()
+        # параллельный повтор с тем же ключом успел закоммитить первым
+        replayed = idempotent.replay(db)
+        if replayed is not None:
+            return replayed
+        raise registration_conflict(exc) from exc
+    except models.EventFullError as exc:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Event is full") from exc
+    metrics.REGISTRATIONS_CREATED.labels("form").inc()
+    return response
+
+
+@api.post(
+    "/registrations/batch/",
+    response_model=RegistrationBatchResponse,
+    description="Регистрация группы посетителей на одно мероприятие",
+)
+def create_registrations_batch(
+    batch: schemas.RegistrationBatchCreate, db: Session = Depends(get_db)
+):
+    """create_registrations_batch"""
+    db_event = db.scalars(
+        select(models.Event).filter(models.Event.id == batch.event_id)
+    ).first()
+    if db_event is None:
+        raise HTTPException(status_code=404, detail="Event not found")
+    try:
+        results = services.register_visitors(db, db_event, batch.visitor_ids)
+        db.commit()
+    except models.EventFullError as exc:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Event is full") from exc
+    except IntegrityError as exc:
+        # посетителя удалили между проверкой и вставкой
+        db.rollback()
+        raise HTTPException(
+            status_code=400, detail="Registrations changed concurrently, retry"
+        ) from exc
+    registered = sum(result["status"] == "registered" for result in results)
+    metrics.REGISTRATIONS_CREATED.labels("batch").inc(registered)
+    return {
+        "status": "ok",
+        "redirect_url": f"/registrations/?event_id={batch.event_id}",
+        "registered": registered,
+        "results": results,
+    }
+
+
+@api.post(
+    "/registrations/reconcile/",
+    response_model=ReconcileResponse,
+    description="Сверка оплат и возвратов по банковской выписке (CSV)",
+)
+def reconcile_payments(file: UploadFile = File(...), db: Session = Depends(get_db)):
+    """reconcile_payments"""
+    with io.TextIOWrapper(file.file, encoding="utf-8-sig", newline="") as stream:
+        report = reconcile.reconcile_payments(db, importer.read_csv(stream))
+    return {"status": "ok", "redirect_url": "/registrations/", **report.as_dict()}
 
 
 @api.put(
@@ -544,9 +695,20 @@ def create_registration(
 def update_registration(
     registration_id: int,
     registration: schemas.RegistrationUpdate,
+    idempotency_key: Optional[str] = Header(None),
     db: Session = Depends(get_db),
 ):
-    """update_registration"""
+    """update_registration; a retry with the same Idempotency-Key gets the
+    stored response without running the update and the status hooks again"""
+    idempotent = idempotency.IdempotentRequest(
+        idempotency_key,
+        "PUT",
+        f"/registrations/{registration_id}/update/",
+        registration.model_dump(mode="json"),
+    )
+    replayed = idempotent.replay(db)
+    if replayed is not None:
+        return replayed
     db_registration = (
         db.query(models.Registration)
         .filter(models.Registration.id == registration_id)
@@ -581,15 +743,44 @@ def update_registration(
         registration.status = "refunded"
         registration.refund_amount = refund_amount
         registration.refunded_at = datetime.now()
+    previous_status = db_registration.status
     for key, value in registration.model_dump().items():
         setattr(db_registration, key, value)
-    db.commit()
-    db.refresh(db_registration)
-    return {
-        "status": "ok",
-        "redirect_url": "/registrations/",
-        "registration": db_registration,
-    }
+    try:
+        db.flush()
+        services.update_event_readiness(
+            db, db_registration.event_id, db_registration.status
+        )
+        db.refresh(db_registration)
+        result = RegistrationUpdateResponse(
+            status="ok",
+            redirect_url="/registrations/",
+            registration=schemas.Registration.model_validate(
+                db_registration, from_attributes=True
+            ),
+        )
+        idempotent.remember(
+            db, Response(result.model_dump_json(), media_type="application/json")
+        )
+        db.commit()
+    except models.EventFullError as exc:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Event is full") from exc
+    except IntegrityError as exc:
+        db.rollback()
+        # параллельный повтор с тем же ключом успел закоммитить первым
+        replayed = idempotent.replay(db)
+        if replayed is not None:
+            return replayed
+        raise HTTPException(
+            status_code=400, detail="Registration changed concurrently, retry"
+        ) from exc
+    if registration.status != previous_status and registration.status in (
+        "paid",
+        "refunded",
+    ):
+        metrics.REGISTRATION_STATUS_CHANGES.labels(registration.status, "form").inc()
+    return result
 
 
 @api.delete("/registrations/{registration_id}/delete/", response_model=DeleteResponse)
@@ -3,7 +3,7 @@
 from datetime import datetime
 from typing import Optional
 
-from pydantic import BaseModel, EmailStr, Field, field_validator
+from pydantic import BaseModel, EmailStr, Field, field_validator, model_validator
 
 EVENT_STATUSES = ["planning", "ready", "active", "completed", "cancelled"]
 
@@ -54,12 +54,19 @@ class EventUpdate(EventBase):
 class Event(EventBase, BaseSchema):
     """event schema"""
 
+class EventDetail(Event):
+    """event schema with registration counters"""
+    registration_count: int
+    paid_count: int
+    total_income: int
+    expected_income: int
+
 class VisitorBase(BaseModel):
     """visitor base schema"""
     first_name: str = Field(..., description="Имя")
     last_name: str = Field(..., description="Фамилия")
     phone: str = Field(..., description="Телефон")
-    email: EmailStr = Field(None, description="Почта")
+    email: Optional[EmailStr] = Field(None, description="Почта")
 
 
 class VisitorUpdate(VisitorBase):
@@ -71,6 +78,11 @@ class VisitorCreate(VisitorBase):
 class Visitor(VisitorBase, BaseSchema):
     """visitor schema"""
 
+class VisitorDetail(Visitor):
+    """visitor schema with registration counters"""
+    registration_count: int
+    events_count: int
+
 REGISTRATION_STATUSES = ["unpaid", "paid", "refunded", "cancelled", "completed"]
 
 
@@ -101,6 +113,62 @@ class RegistrationCreate(RegistrationBase):
 class Registration(RegistrationBase, BaseSchema):
     """registration schema"""
 
+class PaymentRecord(BaseModel):
+    """bank statement record schema"""
+    registration_id: Optional[int] = Field(None, description="ID регистрации")
+    phone: Optional[str] = Field(None, description="Телефон посетителя")
+    amount: int = Field(..., description="Сумма, отрицательная для возврата")
+    paid_at: datetime = Field(..., description="Дата и время операции")
+
+    @field_validator("amount")
+    def amount_non_zero(cls, v):
+        """validate amount"""
+        if v == 0:
+            raise ValueError("amount must be non-zero")
+        return v
+
+    @model_validator(mode="after")
+    def registration_or_phone(self):
+        """validate reference"""
+        if self.registration_id is None and self.phone is None:
+            raise ValueError("registration_id or phone is required")
+        return self
+
+
+class RegistrationBatchCreate(BaseModel):
+    """registration batch create schema"""
+    event_id: int = Field(..., description="ID мероприятия")
+    visitor_ids: list[int] = Field(
+        ..., min_length=1, max_length=10000, description="ID посетителей"
+    )
+
+
+class RegistrationBatchResult(BaseModel):
+    """registration batch result schema"""
+    visitor_id: int
+    status: str
+
+class Page(BaseModel):
+    """keyset page schema"""
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
+
+
+class EventPage(Page):
+    """event page schema"""
+    items: list[Event]
+
+
+class VisitorPage(Page):
+    """visitor page schema"""
+    items: list[Visitor]
+
+
+class RegistrationPage(Page):
+    """registration page schema"""
+    items: list[Registration]
+
+
 class BaseResponse(BaseModel):
     """base response schema"""
     status: str
@@ -113,6 +181,38 @@ class DeleteResponse(BaseResponse):
 class UpdateResponse(BaseResponse):
     """update response schema"""
 
+class ImportRowError(BaseModel):
+    """import row error schema"""
+    row: int
+    error: str
+
+
+class ImportResponse(BaseResponse):
+    """import response schema"""
+    inserted: int
+    errors: list[ImportRowError]
+
+
+class RegistrationBatchResponse(BaseResponse):
+    """registration batch response schema"""
+    registered: int
+    results: list[RegistrationBatchResult]
+
+
+class ReconcileMismatch(BaseModel):
+    """reconcile mismatch schema"""
+    row: int
+    reference: Optional[str]
+    amount: Optional[int]
+    error: str
+
+
+class ReconcileResponse(BaseResponse):
+    """reconcile response schema"""
+    applied: int
+    mismatches: list[ReconcileMismatch]
+
+
 class EventUpdateResponse(UpdateResponse):
     """event update response schema"""
     event: Event
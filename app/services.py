@@ -0,0 +1,257 @@
+"""services"""
+import asyncio
+import logging
+import os
+from datetime import datetime
+
+from sqlalchemy import and_, case, literal, or_, select, true, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from sqlalchemy.sql.functions import coalesce
+
+from . import metrics, models, queries
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def event_status(status, start_at, end_at, now=None) -> str:
+    """status an event should have for its dates"""
+    now = now or datetime.now()
+    if start_at > end_at:
+        return "cancelled"
+    if status != "cancelled":
+        if start_at <= now:
+            status = "active"
+        if end_at <= now:
+            status = "completed"
+    return status
+
+
+def event_status_case(status, now=None):
+    """SQL counterpart of event_status over the events table"""
+    events = models.Event.__table__
+    now = now or datetime.now()
+    return case(
+        (events.c.start_at > events.c.end_at, "cancelled"),
+        (status == "cancelled", "cancelled"),
+        (events.c.end_at <= now, "completed"),
+        (events.c.start_at <= now, "active"),
+        else_=status,
+    )
+
+
+def transition_registrations(db: Session, event_ids, status) -> int:
+    """move registrations of events in the given status with one UPDATE"""
+    registrations = models.Registration.__table__
+    price = coalesce(registrations.c.price, 0)
+    if status in ("active", "completed"):
+        condition = registrations.c.billed_amount.is_not(None)
+        new_status = case(
+            (registrations.c.billed_amount == price, "completed"),
+            (registrations.c.billed_amount < price, "cancelled"),
+            else_=registrations.c.status,
+        )
+    elif status == "cancelled":
+        condition = true()
+        new_status = literal("cancelled")
+    else:
+        return 0
+    rowcount = db.execute(
+        update(registrations)
+        .where(registrations.c.event_id.in_(event_ids), condition)
+        .values(status=new_status)
+        .execution_options(**{models.CHANGED_ROWS: {"events": event_ids}})
+    ).rowcount
+    # статусы не менялись: пересчёт счётчиков по всем регистрациям не нужен
+    if rowcount:
+        models.rebuild_event_counters(db, event_ids)
+    return rowcount
+
+
+def apply_event_status(db: Session, db_event: models.Event, now=None):
+    """recompute the event status from its dates and carry it to registrations"""
+    db_event.status = event_status(
+        db_event.status, db_event.start_at, db_event.end_at, now
+    )
+    db.flush()
+    transition_registrations(db, [db_event.id], db_event.status)
+
+
+def update_event_readiness(db: Session, event_id, registration_status, now=None):
+    """mark the event ready once paid_count reaches visitor_limit, back to planning
+    on a refund; returns the new status or None when the event was not touched"""
+    events = models.Event.__table__
+    statement = (
+        update(events)
+        .where(events.c.id == event_id)
+        .execution_options(**{models.CHANGED_ROWS: {"events": [event_id]}})
+    )
+    if registration_status == "paid":
+        statement = statement.where(
+            events.c.visitor_limit > 0,
+            events.c.paid_count >= events.c.visitor_limit,
+        ).values(status=event_status_case(literal("ready"), now))
+    elif registration_status == "refunded":
+        statement = statement.values(status=event_status_case(literal("planning"), now))
+    else:
+        return None
+    status = db.execute(statement.returning(events.c.status)).scalar()
+    if status is not None:
+        metrics.EVENT_STATUS_TRANSITIONS.labels(status, "readiness").inc()
+        transition_registrations(db, [event_id], status)
+    return status
+
+
+ROLL_OVER_BATCH_SIZE = 1000
+# период фоновой смены статусов в секундах, 0 - только через CLI/cron
+ROLL_OVER_INTERVAL = int(os.getenv("ROLL_OVER_INTERVAL", "0"))
+ROLL_OVER_STATUSES = ("planning", "ready")
+
+
+def due_events_query(now, batch_size):
+    """ids of events whose start_at/end_at passed without a status change"""
+    events = models.Event.__table__
+    return (
+        select(events.c.id)
+        .where(
+            or_(
+                and_(
+                    events.c.status.in_(ROLL_OVER_STATUSES),
+                    events.c.start_at <= now,
+                ),
+                and_(events.c.status == "active", events.c.end_at <= now),
+            )
+        )
+        .limit(batch_size)
+    )
+
+
+def roll_over_events(db: Session, now=None, batch_size=ROLL_OVER_BATCH_SIZE) -> int:
+    """move due events to active/completed in batches, one commit per batch"""
+    events = models.Event.__table__
+    now = now or datetime.now()
+    total = 0
+    while True:
+        event_ids = db.scalars(due_events_query(now, batch_size)).all()
+        if not event_ids:
+            return total
+        moved = db.execute(
+            update(events)
+            .where(events.c.id.in_(event_ids))
+            .values(status=event_status_case(events.c.status, now))
+            .returning(events.c.id, events.c.status)
+            .execution_options(**{models.CHANGED_ROWS: {"events": event_ids}})
+        ).all()
+        by_status = {}
+        for event_id, status in moved:
+            by_status.setdefault(status, []).append(event_id)
+        for status, ids in by_status.items():
+            transition_registrations(db, ids, status)
+        db.commit()
+        for status, ids in by_status.items():
+            metrics.EVENT_STATUS_TRANSITIONS.labels(status, "scheduler").inc(len(ids))
+        total += len(moved)
+
+
+async def roll_over_periodically(interval):
+    """in-app scheduler for roll_over_events"""
+    def run():
+        with SessionLocal() as db:
+            return roll_over_events(db)
+
+    while True:
+        try:
+            moved = await asyncio.to_thread(run)
+            if moved:
+                logger.info("rolled over %s events", moved)
+        except Exception:  # pylint: disable=W0718
+            logger.exception("event roll over failed")
+        await asyncio.sleep(interval)
+
+
+# INSERT ... ON CONFLICT DO NOTHING для поддерживаемых баз
+UPSERT_INSERTS = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}
+
+
+def register_visitors(db: Session, db_event: models.Event, visitor_ids) -> list:
+    """register many visitors for one event with one multi-row INSERT.
+
+    Locks are taken in the order of create_registration: the registrations
+    first, then the event counters. A registration committed concurrently is
+    skipped by ON CONFLICT and reported as already_registered; if the seats
+    were taken meanwhile, adjust_event_counters raises EventFullError."""
+    registrations = models.Registration.__table__
+    visitor_ids = list(dict.fromkeys(visitor_ids))
+    known = set(
+        db.scalars(
+            select(models.Visitor.id).where(models.Visitor.id.in_(visitor_ids))
+        )
+    )
+    registered = set(
+        db.scalars(
+            select(registrations.c.visitor_id).where(
+                registrations.c.event_id == db_event.id,
+                registrations.c.visitor_id.in_(visitor_ids),
+            )
+        )
+    )
+    seats = None
+    if db_event.visitor_limit:
+        seats = max(db_event.visitor_limit - db_event.reserved_count, 0)
+    status = "unpaid" if db_event.price else "paid"
+
+    results = []
+    rows = []
+    for visitor_id in visitor_ids:
+        if visitor_id not in known:
+            result = "visitor_not_found"
+        elif visitor_id in registered:
+            result = "already_registered"
+        elif seats is not None and len(rows) >= seats:
+            result = "event_full"
+        else:
+            result = "registered"
+            rows.append(
+                {
+                    "event_id": db_event.id,
+                    "visitor_id": visitor_id,
+                    "price": db_event.price,
+                    "status": status,
+                }
+            )
+        results.append({"visitor_id": visitor_id, "status": result})
+    if not rows:
+        return results
+
+    new_visitor_ids = [row["visitor_id"] for row in rows]
+    inserted = set(
+        db.scalars(
+            UPSERT_INSERTS[queries.dialect_name(db)](registrations)
+            .values(rows)
+            .on_conflict_do_nothing(index_elements=["event_id", "visitor_id"])
+            .returning(registrations.c.visitor_id)
+            .execution_options(
+                **{
+                    models.CHANGED_ROWS: {
+                        "events": [db_event.id],
+                        "visitors": new_visitor_ids,
+                        "visitor_events": new_visitor_ids,
+                    }
+                }
+            )
+        )
+    )
+    for result in results:
+        if result["status"] == "registered" and result["visitor_id"] not in inserted:
+            result["status"] = "already_registered"
+    if not inserted:
+        return results
+    # multi-row INSERT идёт мимо mapper событий, счётчики двигаем сами
+    deltas = {
+        name: value * len(inserted)
+        for name, value in models.registration_counters(rows[0]).items()
+    }
+    models.adjust_event_counters(db, db_event.id, deltas)
+    update_event_readiness(db, db_event.id, status)
+    return results
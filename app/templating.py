@@ -0,0 +1,50 @@
+"""templating"""
+import logging
+import os
+import time
+
+from jinja2 import FileSystemBytecodeCache
+from starlette.templating import Jinja2Templates
+
+from .utils import format_price, format_datetime_ru
+
+TEMPLATE_DIR = "templates"
+# каталог байткода шаблонов, пустое значение отключает кэш
+TEMPLATE_CACHE_DIR = os.getenv("TEMPLATE_CACHE_DIR", ".jinja_cache")
+
+logger = logging.getLogger(__name__)
+
+
+class BytecodeCache(FileSystemBytecodeCache):
+    """creates its directory on the first write, so rendering works whether
+    or not warm_templates ran"""
+
+    def dump_bytecode(self, bucket):
+        os.makedirs(self.directory, exist_ok=True)
+        super().dump_bytecode(bucket)
+
+
+def bytecode_cache(directory):
+    """bytecode_cache"""
+    if not directory:
+        return None
+    return BytecodeCache(directory)
+
+
+templates = Jinja2Templates(directory=TEMPLATE_DIR)
+templates.env.bytecode_cache = bytecode_cache(TEMPLATE_CACHE_DIR)
+templates.env.filters["format_price"] = format_price
+templates.env.filters["format_datetime_ru"] = format_datetime_ru
+
+
+def warm_templates(env=None) -> dict:
+    """loads every template into the environment, compiling only what the
+    bytecode cache does not have yet"""
+    env = env or templates.env
+    started = time.perf_counter()
+    names = env.list_templates(extensions=["html"])
+    for name in names:
+        env.get_template(name)
+    seconds = time.perf_counter() - started
+    logger.info("warmed %s templates in %.1f ms", len(names), seconds * 1000)
+    return {"templates": len(names), "seconds": seconds}
@@ -1,22 +1,69 @@
 """test_api"""
-# pylint: disable=redefined-outer-name
+# pylint: disable=redefined-outer-name,too-many-lines
+import json
 import string
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from random import choices
 
 import pytest
+from fastapi import FastAPI, Request
+from fastapi.staticfiles import StaticFiles
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from prometheus_client import REGISTRY
+from sqlalchemy import create_engine, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import (
+    IntegrityError,
+    InvalidRequestError,
+    TimeoutError as PoolTimeoutError,
+)
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
-
+from sqlalchemy.pool import NullPool
+
+from app import (
+    bus,
+    cache,
+    database,
+    idempotency,
+    metrics,
+    queries,
+    reconcile,
+    services,
+)
+from app.async_routes import async_api
+from app.bus import FileTransport, InvalidationBus
+from app.cache import LocalBackend
 from app.main import app
-from app.database import Base, get_db
-from app.models import Event, Visitor, Registration
+from app.database import Base, get_db, get_async_db, get_async_read_db, get_read_db
+from app.instrumentation import assert_max_queries, query_count
+from app.routes import api, registration_conflict
+from app.templating import bytecode_cache, templates, warm_templates
+from app.models import (
+    Event,
+    EventFullError,
+    IdempotencyKey,
+    Visitor,
+    Registration,
+    rebuild_event_counters,
+)
+from app.utils import Keyset, PAGE_SIZE, with_loaders
 
 # Настройки для тестовой базы данных
 SQLALCHEMY_DATABASE_URL = "sqlite:///./test.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL)
+engine = database.instrument_engine(
+    create_engine(SQLALCHEMY_DATABASE_URL, poolclass=database.InstrumentedQueuePool),
+    "test",
+)
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine(
+    database.async_database_url(SQLALCHEMY_DATABASE_URL), poolclass=NullPool
+)
+TestingAsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
 
 
 def override_get_db():
@@ -28,8 +75,19 @@ def override_get_db():
         db.close()
 
 
+async def override_get_async_db():
+    """Определение функции get_async_db для тестов"""
+    async with TestingAsyncSessionLocal() as db:
+        yield db
+
+
 # Переопределение зависимости get_db в приложении
 app.dependency_overrides[get_db] = override_get_db
+app.dependency_overrides[get_read_db] = override_get_db
+app.dependency_overrides[get_async_db] = override_get_async_db
+app.dependency_overrides[get_async_read_db] = override_get_async_db
+# Ленивая загрузка связей в шаблонах должна падать
+database.STRICT_LOADING = True
 
 
 @pytest.fixture(scope="module")
@@ -49,6 +107,18 @@ def client(db): # pylint: disable=W0613
         yield client
 
 
+@pytest.fixture(scope="module")
+def async_client(db): # pylint: disable=W0613
+    """приложение в режиме DB_MODE=async"""
+    async_app = FastAPI()
+    async_app.mount("/static", StaticFiles(directory="static"), name="static")
+    async_app.include_router(async_api)
+    async_app.include_router(api)
+    async_app.dependency_overrides = app.dependency_overrides
+    with TestClient(async_app) as client:
+        yield client
+
+
 def create_test_event(db):
     """create_test_event"""
     event = Event(
@@ -112,6 +182,52 @@ def test_get_events(client):
     assert "text/html" in response.headers["content-type"]
 
 
+def test_get_events_pagination(client, db):
+    """get_events_pagination"""
+    for _ in range(3):
+        create_test_event(db)
+    params = {"sort_by": "price", "sort_order": 1, "limit": 2}
+    first = client.get("/events/", params=params)
+    assert first.status_code == 200
+    first_ids = [event.id for event in first.context["events"]]
+    assert len(first_ids) == 2
+    assert first.context["prev_url"] is None
+    assert first.context["next_url"] is not None
+
+    second = client.get(first.context["next_url"])
+    assert second.status_code == 200
+    second_ids = [event.id for event in second.context["events"]]
+    assert second_ids
+    assert not set(first_ids) & set(second_ids)
+
+    back = client.get(second.context["prev_url"])
+    assert [event.id for event in back.context["events"]] == first_ids
+
+
+def test_get_events_invalid_cursor(client):
+    """get_events_invalid_cursor"""
+    response = client.get("/events/", params={"after": "invalid"})
+    assert response.status_code == 400
+
+
+def test_get_events_search(client, db):
+    """get_events_search"""
+    event = create_test_event(db)
+    event.location = "Trigram Hall"
+    db.commit()
+    response = client.get("/events/", params={"search": "gram ha"})
+    assert response.status_code == 200
+    assert [found.id for found in response.context["events"]] == [event.id]
+
+
+def test_search_rank():
+    """search_rank"""
+    assert queries.search_rank(queries.EVENT_SEARCH_COLUMNS, "rock", "sqlite") is None
+    rank = queries.search_rank(queries.EVENT_SEARCH_COLUMNS, "rock", "postgresql")
+    sql = str(rank.compile(dialect=postgresql.dialect()))
+    assert "word_similarity" in sql
+
+
 def test_read_event(client, db):
     """read_event"""
     event = create_test_event(db)
@@ -120,6 +236,144 @@ def test_read_event(client, db):
     assert "text/html" in response.headers["content-type"]
 
 
+def test_event_counters(client, db):
+    """event_counters"""
+    event = create_test_event(db)
+    event.status = "planning"
+    event.start_at = datetime(2100, 1, 1, 0, 0, 0)
+    event.end_at = datetime(2100, 1, 1, 1, 0, 0)
+    db.commit()
+    first = create_test_registration(db, event.id, create_test_visitor(db).id)
+    second = create_test_registration(db, event.id, create_test_visitor(db).id)
+    client.put(
+        f"/registrations/{first.id}/update/",
+        json={"billed_amount": "100", "refund_amount": "0"},
+    )
+    client.delete(f"/registrations/{second.id}/delete/")
+    db.refresh(event)
+    counters = (
+        event.registration_count,
+        event.paid_count,
+        event.total_income,
+        event.expected_income,
+    )
+    assert counters == (1, 1, 100, 100)
+
+    event.registration_count = 0
+    event.total_income = 0
+    db.commit()
+    rebuild_event_counters(db.connection(), [event.id])
+    db.commit()
+    db.refresh(event)
+    assert (
+        event.registration_count,
+        event.paid_count,
+        event.total_income,
+        event.expected_income,
+    ) == counters
+
+
+def test_event_readiness(client, db):
+    """paid registrations filling visitor_limit make the event ready"""
+    event = create_test_event(db)
+    event.status = "planning"
+    event.visitor_limit = 1
+    event.start_at = datetime(2100, 1, 1, 0, 0, 0)
+    event.end_at = datetime(2100, 1, 1, 1, 0, 0)
+    db.commit()
+    registration = create_test_registration(db, event.id, create_test_visitor(db).id)
+    client.put(
+        f"/registrations/{registration.id}/update/",
+        json={"billed_amount": "100", "refund_amount": "0"},
+    )
+    db.refresh(event)
+    assert event.status == "ready"
+    client.put(
+        f"/registrations/{registration.id}/update/",
+        json={"billed_amount": "100", "refund_amount": "100"},
+    )
+    db.refresh(event)
+    assert event.status == "planning"
+
+
+def test_event_status_transition(client, db):
+    """finished events complete paid and cancel underpaid registrations"""
+    event = create_test_event(db)
+    paid = create_test_registration(db, event.id, create_test_visitor(db).id)
+    underpaid = create_test_registration(db, event.id, create_test_visitor(db).id)
+    paid.billed_amount = 100
+    underpaid.billed_amount = 50
+    db.commit()
+    response = client.put(
+        f"/events/{event.id}/update/",
+        json={
+            "title": event.title,
+            "status": "planning",
+            "location": event.location,
+            "start_at": "2023-01-01T00:00:00",
+            "end_at": "2023-01-01T01:00:00",
+            "price": 100,
+        },
+    )
+    assert response.json()["event"]["status"] == "completed"
+    db.refresh(paid)
+    db.refresh(underpaid)
+    assert (paid.status, underpaid.status) == ("completed", "cancelled")
+    assert services.event_status(
+        "planning", datetime(2100, 1, 2), datetime(2100, 1, 1)
+    ) == "cancelled"
+
+
+def test_roll_over_events(db):
+    """roll_over_events"""
+    event = create_test_event(db)
+    event.status = "planning"
+    paid = create_test_registration(db, event.id, create_test_visitor(db).id)
+    paid.billed_amount = 100
+    upcoming = create_test_event(db)
+    upcoming.status = "planning"
+    upcoming.start_at = datetime(2100, 1, 1, 0, 0, 0)
+    upcoming.end_at = datetime(2100, 1, 1, 1, 0, 0)
+    db.commit()
+    assert services.roll_over_events(db, batch_size=2) >= 1
+    assert services.roll_over_events(db) == 0
+    db.refresh(event)
+    db.refresh(paid)
+    db.refresh(upcoming)
+    assert (event.status, paid.status, upcoming.status) == (
+        "completed",
+        "completed",
+        "planning",
+    )
+
+
+def test_page_cache_etag(client, db, monkeypatch):
+    """unchanged pages answer 304 and from the rendered cache"""
+    event = create_test_event(db)
+    # CURRENT_TIMESTAMP в SQLite с точностью до секунды
+    event.updated_at = datetime(2000, 1, 1)
+    db.commit()
+    url = f"/events/{event.id}"
+    # без шины коммиты других воркеров не дойдут: страницы не кэшируются
+    assert "etag" not in client.get(url).headers
+    monkeypatch.setattr(cache.bus_state, "attached", True)
+    first = client.get(url)
+    etag = first.headers["etag"]
+    assert client.get(url, headers={"If-None-Match": etag}).status_code == 304
+    cached = client.get(url)
+    assert cached.headers["etag"] == etag
+    assert cached.text == first.text
+
+    event.title = "Renamed Event"
+    db.commit()
+    changed = client.get(url, headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["etag"] != etag
+    assert "Renamed Event" in changed.text
+    db.refresh(event)
+    assert event.updated_at > datetime(2000, 1, 1)
+
+
 def test_read_event_not_found(client):
     """read_event_not_found"""
     response = client.get("/events/999999")
@@ -182,6 +436,8 @@ def test_update_event(client, db):
     assert response.status_code == 200
     assert response.json()["status"] == "ok"
     assert response.json()["event"]["title"] == "Updated Event"
+    # без регистраций смена статуса не пересчитывает счётчики
+    assert_max_queries(response, 4)
 
 
 def test_update_event_not_found(client):
@@ -253,6 +509,44 @@ def test_create_visitor(client):
     assert "text/html" in response.headers["content-type"]
 
 
+def test_import_visitors(client, db):
+    """import_visitors"""
+    existing = create_test_visitor(db)
+    csv_data = (
+        "first_name,last_name,phone,email\n"
+        "Ann,Lee,5550000001,ann.lee@example.com\n"
+        f"Bob,Kim,{existing.phone},\n"
+        "Cid,Roe,5550000001,\n"
+        "Dan,Fox,5550000002,not-an-email\n"
+        "Eve,Ray,5550000003,\n"
+    )
+    response = client.post(
+        "/visitors/import/",
+        files={"file": ("visitors.csv", csv_data, "text/csv")},
+    )
+    assert response.status_code == 200
+    body = response.json()
+    assert body["inserted"] == 2
+    assert [error["row"] for error in body["errors"]] == [3, 4, 5]
+    assert db.query(Visitor).filter(Visitor.phone == "5550000003").count() == 1
+
+
+def test_import_events(client):
+    """import_events"""
+    csv_data = (
+        "title,location,start_at,end_at,price,visitor_limit\n"
+        "Imported,Hall,2030-01-01T10:00:00,2030-01-01T12:00:00,500,\n"
+        "Broken,Hall,not-a-date,2030-01-01T12:00:00,500,\n"
+    )
+    response = client.post(
+        "/events/import/",
+        files={"file": ("events.csv", csv_data, "text/csv")},
+    )
+    assert response.status_code == 200
+    assert response.json()["inserted"] == 1
+    assert response.json()["errors"][0]["row"] == 3
+
+
 def test_update_visitor(client, db):
     """update_visitor"""
     visitor = create_test_visitor(db)
@@ -277,6 +571,86 @@ def test_get_registrations(client):
     assert "text/html" in response.headers["content-type"]
 
 
+def test_get_registrations_filters(client, db):
+    """get_registrations_filters"""
+    event = create_test_event(db)
+    visitor = create_test_visitor(db)
+    client.get("/registrations/")
+    create_test_registration(db, event.id, visitor.id)
+    response = client.get("/registrations/")
+    assert response.status_code == 200
+    assert response.context["events"][event.id] == event.title
+    assert response.context["visitors"][visitor.id] == "John Doe"
+
+    client.put(
+        f"/visitors/{visitor.id}/update/",
+        json={
+            "first_name": "Jane",
+            "last_name": "Roe",
+            "phone": visitor.phone,
+            "email": visitor.email,
+        },
+    )
+    response = client.get("/registrations/")
+    assert response.context["visitors"][visitor.id] == "Jane Roe"
+
+
+def test_strict_loading(db):
+    """strict_loading"""
+    event = create_test_event(db)
+    visitor = create_test_visitor(db)
+    registration = create_test_registration(db, event.id, visitor.id)
+    session = TestingSessionLocal()
+    try:
+        loaded = (
+            with_loaders(session.query(Registration))
+            .filter(Registration.id == registration.id)
+            .one()
+        )
+        with pytest.raises(InvalidRequestError):
+            _ = loaded.event
+    finally:
+        session.close()
+
+
+def test_update_registration_form(client, db):
+    """update_registration_form"""
+    event = create_test_event(db)
+    visitor = create_test_visitor(db)
+    registration = create_test_registration(db, event.id, visitor.id)
+    response = client.get(f"/registrations/{registration.id}/update/")
+    assert response.status_code == 200
+    assert "text/html" in response.headers["content-type"]
+
+
+def test_export_registrations(client, db):
+    """export_registrations"""
+    event = create_test_event(db)
+    visitor = create_test_visitor(db)
+    registration = create_test_registration(db, event.id, visitor.id)
+    response = client.get("/registrations/export/", params={"event_id": event.id})
+    assert response.status_code == 200
+    assert "text/csv" in response.headers["content-type"]
+    header, *rows = response.text.splitlines()
+    assert header.startswith("id,event_id,event_title,visitor_id,first_name")
+    assert [row.split(",")[0] for row in rows] == [str(registration.id)]
+
+    response = client.get(
+        "/registrations/export/",
+        params={"event_id": event.id, "format": "jsonl", "status": "unpaid"},
+    )
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert lines[0]["event_title"] == event.title
+    assert lines[0]["visitor_id"] == visitor.id
+
+
+def test_export_registrations_invalid_format(client):
+    """export_registrations_invalid_format"""
+    response = client.get("/registrations/export/", params={"format": "xml"})
+    assert response.status_code == 422
+
+
 def test_create_registration(client, db):
     """create_registration"""
     event = create_test_event(db)
@@ -322,6 +696,236 @@ def test_create_registration_duplicate(client, db):
         data={"event_id": event.id, "visitor_id": visitor.id},
     )
     assert response.status_code == 400
+    assert response.json()["detail"] == "Registration with this params already exists"
+
+
+def test_registration_conflict():
+    """only the (event_id, visitor_id) index means a duplicate, a missing
+    event or visitor is 404"""
+    fk_engine = create_engine("sqlite://")
+    with fk_engine.begin() as connection:
+        connection.execute(text("PRAGMA foreign_keys = ON"))
+        Base.metadata.create_all(connection)
+        for statement in (
+            "INSERT INTO events (id, title, start_at, end_at, location, price) "
+            "VALUES (1, 'e', '2100-01-01', '2100-01-01', 'l', 0)",
+            "INSERT INTO visitors (id, first_name, last_name, phone) "
+            "VALUES (1, 'a', 'b', '1')",
+            "INSERT INTO registrations (event_id, visitor_id) VALUES (1, 1)",
+        ):
+            connection.execute(text(statement))
+    statuses = []
+    for event_id in (1, 2):
+        with pytest.raises(IntegrityError) as error, fk_engine.begin() as connection:
+            connection.execute(text("PRAGMA foreign_keys = ON"))
+            connection.execute(
+                text("INSERT INTO registrations (event_id, visitor_id) VALUES (:id, 1)"),
+                {"id": event_id},
+            )
+        statuses.append(registration_conflict(error.value).status_code)
+    assert statuses == [400, 404]
+
+
+def test_create_registration_event_full(client, db):
+    """create_registration_event_full"""
+    event = create_test_event(db)
+    event.visitor_limit = 1
+    db.commit()
+    for expected in (200, 400):
+        visitor = create_test_visitor(db)
+        response = client.post(
+            "/registrations/create/",
+            data={"event_id": event.id, "visitor_id": visitor.id},
+        )
+        assert response.status_code == expected
+    db.refresh(event)
+    assert event.reserved_count == 1
+
+
+def test_event_capacity_concurrent(db):
+    """concurrent registrations never exceed visitor_limit"""
+    event = create_test_event(db)
+    event.visitor_limit = 5
+    db.commit()
+    visitor_ids = [create_test_visitor(db).id for _ in range(20)]
+
+    def register(visitor_id):
+        session = TestingSessionLocal()
+        try:
+            session.add(
+                Registration(
+                    event_id=event.id, visitor_id=visitor_id, price=100, status="unpaid"
+                )
+            )
+            session.commit()
+            return True
+        except EventFullError:
+            session.rollback()
+            return False
+        finally:
+            session.close()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(register, visitor_ids))
+    assert results.count(True) == 5
+    db.refresh(event)
+    assert event.reserved_count == 5
+    assert db.query(Registration).filter_by(event_id=event.id).count() == 5
+
+
+def test_query_plans_use_indexes(db):
+    """EXPLAIN QUERY PLAN picks the composite indexes"""
+    def plan(statement):
+        compiled = statement.compile(engine, compile_kwargs={"literal_binds": True})
+        rows = db.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).all()
+        return " ".join(row[3] for row in rows)
+
+    assert "ix_registrations_event_id_status" in plan(
+        queries.registration_rows_query(1, None, "paid")
+    )
+    assert "ux_registrations_event_id_visitor_id" in plan(
+        queries.registration_rows_query(1, 2)
+    )
+    for sort_order in (None, 1):
+        keyset = Keyset(Event, "start_at", sort_order, None, None, PAGE_SIZE)
+        assert "ix_events_start_at_id" in plan(keyset.apply(queries.events_query()))
+
+
+def test_create_registration_ignores_entity_cache(client, db, monkeypatch):
+    """the price of a new registration comes from the database, not from an
+    entity cache another worker's change did not reach"""
+    monkeypatch.setattr(cache.bus_state, "attached", True)
+    event = create_test_event(db)
+    client.get(f"/api/events/{event.id}")
+    with engine.begin() as connection:
+        connection.execute(
+            text("UPDATE events SET price = 500 WHERE id = :id"), {"id": event.id}
+        )
+    visitor = create_test_visitor(db)
+    response = client.post(
+        "/registrations/create/",
+        data={"event_id": event.id, "visitor_id": visitor.id},
+        follow_redirects=False,
+    )
+    assert response.status_code == 303
+    registration = db.query(Registration).filter_by(visitor_id=visitor.id).one()
+    assert registration.price == 500
+
+
+def test_create_registrations_batch(client, db):
+    """create_registrations_batch"""
+    event = create_test_event(db)
+    event.visitor_limit = 3
+    db.commit()
+    visitors = [create_test_visitor(db).id for _ in range(4)]
+    create_test_registration(db, event.id, visitors[0])
+    response = client.post(
+        "/registrations/batch/",
+        json={"event_id": event.id, "visitor_ids": [*visitors, visitors[1], 999999]},
+    )
+    assert response.status_code == 200
+    assert response.json()["registered"] == 2
+    assert [result["status"] for result in response.json()["results"]] == [
+        "already_registered",
+        "registered",
+        "registered",
+        "event_full",
+        "visitor_not_found",
+    ]
+    db.refresh(event)
+    assert (event.registration_count, event.reserved_count) == (3, 3)
+
+    response = client.post(
+        "/registrations/batch/", json={"event_id": 999999, "visitor_ids": [1]}
+    )
+    assert response.status_code == 404
+
+
+def test_register_visitors_concurrent_duplicate(db):
+    """a registration committed after the pre-check is skipped, not a 500"""
+    event = create_test_event(db)
+    visitors = [create_test_visitor(db).id for _ in range(2)]
+    create_test_registration(db, event.id, visitors[0])
+    session = TestingSessionLocal()
+    scalars = session.scalars
+    calls = []
+
+    def stale_precheck(statement, *args, **kwargs):
+        calls.append(statement)
+        if len(calls) == 2:
+            # проверка видит снимок до параллельной регистрации
+            return []
+        return scalars(statement, *args, **kwargs)
+
+    session.scalars = stale_precheck
+    db_event = session.get(Event, event.id)
+    results = services.register_visitors(session, db_event, visitors)
+    session.commit()
+    session.close()
+    assert [result["status"] for result in results] == [
+        "already_registered",
+        "registered",
+    ]
+    db.refresh(event)
+    assert event.registration_count == 2
+
+
+def test_reconcile_payments(client, db):
+    """reconcile_payments"""
+    event = create_test_event(db)
+    event.status = "planning"
+    event.visitor_limit = 2
+    event.start_at = datetime(2100, 1, 1, 0, 0, 0)
+    event.end_at = datetime(2100, 1, 1, 1, 0, 0)
+    db.commit()
+    by_id = create_test_registration(db, event.id, create_test_visitor(db).id)
+    visitor = create_test_visitor(db)
+    by_phone = create_test_registration(db, event.id, visitor.id)
+    csv_data = (
+        "registration_id,phone,amount,paid_at\n"
+        f"{by_id.id},,100,2026-10-01T10:00:00\n"
+        f",{visitor.phone},100,2026-10-01T11:00:00\n"
+        f"{by_id.id},,100,2026-10-01T12:00:00\n"
+        ",0000000000,100,2026-10-01T12:00:00\n"
+        f"{by_phone.id},,-100,2026-10-02T09:00:00\n"
+    )
+    response = client.post(
+        "/registrations/reconcile/",
+        files={"file": ("statement.csv", csv_data, "text/csv")},
+    )
+    assert response.status_code == 200
+    assert response.json()["applied"] == 3
+    assert [mismatch["row"] for mismatch in response.json()["mismatches"]] == [4, 5]
+    db.refresh(by_id)
+    db.refresh(by_phone)
+    db.refresh(event)
+    assert (by_id.status, by_phone.status) == ("paid", "refunded")
+    assert (event.paid_count, event.total_income, event.status) == (1, 100, "planning")
+
+
+def test_reconcile_locks_registrations(db, monkeypatch):
+    """the rows are locked from the status check until the bulk UPDATE commits"""
+    statements = []
+    execute = db.execute
+
+    def capture(statement, *args, **kwargs):
+        statements.append(statement)
+        return execute(statement, *args, **kwargs)
+
+    monkeypatch.setattr(db, "execute", capture)
+    reconcile.load_registrations(
+        db, [(1, {"registration_id": 1, "phone": None, "amount": 100})]
+    )
+    sql = str(statements[0].compile(dialect=postgresql.dialect()))
+    assert sql.endswith("ORDER BY registrations.id FOR UPDATE OF registrations")
+    db.rollback()
+
+    # строки чанка, где ни одна запись не подошла, не остаются заблокированными
+    report = reconcile.reconcile_payments(
+        db, [(2, {"registration_id": "999999", "amount": "100", "paid_at": "2026-10-01"})]
+    )
+    assert report.as_dict()["mismatches"][0]["error"] == "registration not found"
+    assert not db.in_transaction()
 
 
 def test_update_registration(client, db):
@@ -338,6 +942,53 @@ def test_update_registration(client, db):
     assert response.json()["registration"]["status"] == "paid"
 
 
+def test_idempotency_key(client, db, monkeypatch):
+    """retries with the same Idempotency-Key replay the stored response"""
+    event = create_test_event(db)
+    visitor = create_test_visitor(db)
+    data = {"event_id": event.id, "visitor_id": visitor.id}
+    headers = {"Idempotency-Key": f"create-{event.id}-{visitor.id}"}
+    for _ in range(2):
+        response = client.post(
+            "/registrations/create/", data=data, headers=headers, follow_redirects=False
+        )
+        assert response.status_code == 303
+        assert response.headers["location"] == "/registrations/"
+    assert response.headers["idempotent-replayed"] == "true"
+    registrations = db.query(Registration).filter(Registration.event_id == event.id)
+    assert registrations.count() == 1
+
+    url = f"/registrations/{registrations.one().id}/update/"
+    headers = {"Idempotency-Key": f"pay-{event.id}"}
+    first = client.put(url, json={"billed_amount": "100"}, headers=headers)
+    retry = client.put(url, json={"billed_amount": "100"}, headers=headers)
+    assert retry.json() == first.json()
+    assert retry.headers["idempotent-replayed"] == "true"
+
+    response = client.put(url, json={"refund_amount": "100"}, headers=headers)
+    assert response.status_code == 422
+
+    # параллельный запрос с тем же ключом ещё не закоммитил к первой проверке
+    replay = idempotency.IdempotentRequest.replay
+    calls = []
+
+    def late_replay(self, session):
+        calls.append(self.key)
+        return replay(self, session) if len(calls) > 1 else None
+
+    monkeypatch.setattr(idempotency.IdempotentRequest, "replay", late_replay)
+    response = client.put(url, json={"billed_amount": "100"}, headers=headers)
+    assert response.json() == first.json()
+    assert response.headers["idempotent-replayed"] == "true"
+    assert len(calls) == 2
+    monkeypatch.undo()
+
+    db.query(IdempotencyKey).update({"expires_at": datetime(2000, 1, 1)})
+    db.commit()
+    assert idempotency.purge_expired(db) >= 2
+    assert db.query(IdempotencyKey).count() == 0
+
+
 def test_update_registration_not_found(client):
     """update_registration"""
     response = client.put(
@@ -362,3 +1013,321 @@ def test_delete_registration_not_found(client):
     """delete_registration"""
     response = client.delete("/registrations/999999/delete/")
     assert response.status_code == 404
+
+
+def test_json_api(client, db):
+    """json_api"""
+    event = create_test_event(db)
+    visitor = create_test_visitor(db)
+    registration = create_test_registration(db, event.id, visitor.id)
+
+    response = client.get("/api/events/", params={"limit": 1})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/json"
+    page = response.json()
+    assert len(page["items"]) == 1
+    assert page["next_cursor"] is not None
+
+    response = client.get(f"/api/events/{event.id}")
+    assert response.json()["title"] == event.title
+    assert response.json()["registration_count"] == 1
+
+    response = client.get(f"/api/visitors/{visitor.id}")
+    assert response.json()["phone"] == visitor.phone
+    assert response.json()["events_count"] == 1
+
+    response = client.get("/api/registrations/", params={"event_id": event.id})
+    assert [item["id"] for item in response.json()["items"]] == [registration.id]
+
+    response = client.get(f"/api/registrations/{registration.id}")
+    assert response.json()["visitor_id"] == visitor.id
+
+
+def test_json_api_not_found(client):
+    """json_api_not_found"""
+    for path in ("events", "visitors", "registrations"):
+        response = client.get(f"/api/{path}/999999")
+        assert response.status_code == 404
+
+
+def test_async_pages(async_client, db):
+    """async_pages"""
+    event = create_test_event(db)
+    visitor = create_test_visitor(db)
+    create_test_registration(db, event.id, visitor.id)
+    for url in (
+        "/events/",
+        f"/events/{event.id}",
+        "/visitors/",
+        f"/visitors/{visitor.id}",
+        f"/registrations/?event_id={event.id}",
+    ):
+        response = async_client.get(url)
+        assert response.status_code == 200, url
+        assert "text/html" in response.headers["content-type"]
+    assert [r.visitor_id for r in response.context["registrations"]] == [visitor.id]
+
+
+def test_async_read_event_not_found(async_client):
+    """async_read_event_not_found"""
+    response = async_client.get("/events/999999")
+    assert response.status_code == 404
+
+
+def test_warm_templates(tmp_path):
+    """warm_templates"""
+    warmed = warm_templates()
+    assert warmed["templates"] == len(templates.env.list_templates(extensions=["html"]))
+    assert templates.env.bytecode_cache is not None
+
+    # каталог кэша появляется при первой компиляции, даже без warm_templates
+    directory = tmp_path / "jinja"
+    env = templates.env.overlay(bytecode_cache=bytecode_cache(str(directory)))
+    assert not directory.exists()
+    env.get_template("index.html")
+    assert list(directory.iterdir())
+
+
+def test_query_counts(client, db):
+    """pages keep a fixed number of statements however many rows they show"""
+    event = create_test_event(db)
+    for _ in range(3):
+        create_test_registration(db, event.id, create_test_visitor(db).id)
+    visitor = create_test_visitor(db)
+    create_test_registration(db, event.id, visitor.id)
+    for url, limit in (
+        ("/events/", 1),
+        (f"/events/{event.id}", 1),
+        ("/visitors/", 1),
+        (f"/visitors/{visitor.id}", 2),
+        ("/registrations/", 3),
+        (f"/api/events/{event.id}", 1),
+        (f"/api/registrations/?event_id={event.id}", 1),
+    ):
+        response = client.get(url)
+        assert response.status_code == 200, url
+        assert "db;dur=" in response.headers["server-timing"]
+        assert_max_queries(response, limit)
+
+
+def test_pool_stats(client):
+    """pool_stats"""
+    client.get("/events/")
+    response = client.get("/pool/stats/")
+    assert response.status_code == 200
+    stats = response.json()["test"]
+    assert stats["pool"] == "InstrumentedQueuePool"
+    assert stats["checkouts"] > 0
+
+    # ожиданием считается только checkout из исчерпанного пула
+    contended = database.instrument_engine(
+        create_engine(
+            SQLALCHEMY_DATABASE_URL,
+            poolclass=database.InstrumentedQueuePool,
+            pool_size=1,
+            max_overflow=0,
+            pool_timeout=0.05,
+        ),
+        "contended",
+    )
+    with contended.connect():
+        pass
+    with contended.connect():
+        with pytest.raises(PoolTimeoutError):
+            contended.connect()
+    stats = client.get("/pool/stats/").json()["contended"]
+    assert stats["checkouts"] == 2
+    assert stats["waits"] == 1
+    assert stats["timeouts"] == 1
+    database.POOL_STATS.pop("contended")
+
+
+def test_entity_cache(client, db, monkeypatch):
+    """PK lookups come from the entity cache until a commit changes the row"""
+    event = create_test_event(db)
+    # без шины изменения других воркеров не дойдут: кэш не используется
+    client.get(f"/api/events/{event.id}")
+    assert query_count(client.get(f"/api/events/{event.id}")) == 1
+    monkeypatch.setattr(cache.bus_state, "attached", True)
+    client.get(f"/api/events/{event.id}")
+    assert_max_queries(client.get(f"/api/events/{event.id}"), 0)
+
+    create_test_registration(db, event.id, create_test_visitor(db).id)
+    assert client.get(f"/api/events/{event.id}").json()["registration_count"] == 1
+    event.title = "Renamed Event"
+    db.commit()
+    assert client.get(f"/api/events/{event.id}").json()["title"] == "Renamed Event"
+
+    stats = client.get("/cache/stats/").json()
+    assert stats["hits"] > 0
+    assert stats["misses"] > 0
+
+
+def test_local_backend_lru_ttl():
+    """least recently used entries go first, expired ones are misses"""
+    backend = LocalBackend(max_size=2, ttl=60)
+    backend.set("events:1", 1)
+    backend.set("events:2", 2)
+    backend.get("events:1")
+    backend.set("events:3", 3)
+    assert backend.get("events:2") is None
+    assert backend.get("events:1") == 1
+    backend.delete_prefix(["events:"])
+    assert backend.stats()["size"] == 0
+    backend.ttl = 0
+    backend.set("events:1", 1)
+    assert backend.get("events:1") is None
+    assert backend.stats()["evictions"] == 1
+
+
+def test_invalidation_bus(client, db, tmp_path, monkeypatch):
+    """a commit of one worker reaches the caches of another through the bus"""
+    monkeypatch.setattr(cache.bus_state, "attached", True)
+    path = str(tmp_path / "bus")
+    sender = InvalidationBus(FileTransport(path))
+    receiver = InvalidationBus(FileTransport(path))
+    sender.transport.connect()
+    receiver.transport.connect()
+    cache.change_listeners.append(sender.publish)
+    try:
+        event = create_test_event(db)
+        event.title = "Changed Elsewhere"
+        db.commit()
+    finally:
+        cache.change_listeners.remove(sender.publish)
+    sender.step()
+
+    # у другого воркера в кэше осталась старая версия
+    key = cache.entity_key("events", event.id)
+    cache.entity_cache.set(key, {"id": event.id, "title": "Test Event"})
+    receiver.step()
+    assert cache.entity_cache.get(key) is None
+    assert client.get(f"/api/events/{event.id}").json()["title"] == "Changed Elsewhere"
+
+    sender.overflowed = True
+    sender.step()
+    cache.entity_cache.set(key, {"id": event.id})
+    receiver.step()
+    assert cache.entity_cache.get(key) is None
+
+
+def test_configured_bus_transaction_pooler(monkeypatch):
+    """LISTEN does not go through a transaction pooler"""
+    monkeypatch.setattr(bus, "INVALIDATION_BUS", "postgres")
+    monkeypatch.setattr(bus, "DB_POOLER_MODE", "transaction")
+    with pytest.raises(RuntimeError):
+        bus.configured_bus()
+    monkeypatch.setattr(bus, "INVALIDATION_DATABASE_URL", "sqlite://")
+    assert bus.configured_bus().transport.engine.url.render_as_string() == "sqlite://"
+
+
+def test_metrics(client, db):
+    """metrics"""
+    event = create_test_event(db)
+    client.get(f"/events/{event.id}")
+    client.post(
+        "/registrations/create/",
+        data={"event_id": event.id, "visitor_id": create_test_visitor(db).id},
+    )
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    body = response.text
+    assert 'http_requests_total{method="GET",route="/events/{event_id}"' in body
+    assert 'registrations_created_total{source="form"}' in body
+    assert 'db_pool_checked_out{engine="test"}' in body
+
+
+def test_pool_metrics_counters(monkeypatch):
+    """pool totals are exported as counters that grow by the delta"""
+    totals = {"checked_out": 0, "overflow": 0, "wait_seconds": 1.5, "timeouts": 2}
+    monkeypatch.setattr(metrics, "pool_stats", lambda: {"counted": totals})
+
+    def sample(name):
+        return REGISTRY.get_sample_value(name, {"engine": "counted"})
+
+    metrics.observe_pools()
+    metrics.observe_pools()
+    assert (sample("db_pool_wait_seconds_total"), sample("db_pool_timeouts_total")) == (
+        1.5,
+        2,
+    )
+    totals.update(wait_seconds=2.0, timeouts=3)
+    metrics.observe_pools()
+    assert (sample("db_pool_wait_seconds_total"), sample("db_pool_timeouts_total")) == (
+        2.0,
+        3,
+    )
+
+
+def test_replica_set(client, monkeypatch):
+    """replicas take turns, broken ones fall back to primary, writes pin"""
+    broken = create_engine("sqlite:////nonexistent/replica.db")
+    replicas = database.ReplicaSet([broken, engine], retry_after=60)
+    monkeypatch.setattr(database, "SessionLocal", TestingSessionLocal)
+    for _ in range(2):
+        with replicas.session() as session:
+            assert session.get_bind() is engine
+    assert replicas.candidates() == [engine]
+    with database.ReplicaSet([broken]).session() as session:
+        assert session.get_bind() is engine
+
+    monkeypatch.setattr(database.replicas, "engines", [broken])
+    response = client.post(
+        "/events/create/",
+        data={
+            "title": "Pinned",
+            "location": "Hall",
+            "start_at": "2100-01-01T00:00:00",
+            "end_at": "2100-01-01T01:00:00",
+            "price": 0,
+        },
+        follow_redirects=False,
+    )
+    assert response.status_code == 303
+    pin = response.cookies[database.PRIMARY_PIN_COOKIE]
+    cookie = f"{database.PRIMARY_PIN_COOKIE}={pin}".encode()
+    assert database.primary_pinned(
+        Request({"type": "http", "headers": [(b"cookie", cookie)]})
+    )
+    assert client.get("/events/").status_code == 200
+    client.cookies.clear()
+
+
+def test_get_read_db(monkeypatch):
+    """get_read_db reads from a replica unless the pin cookie is fresh and
+    falls back to primary when no replica connects"""
+    replica = create_engine("sqlite://")
+    broken = create_engine("sqlite:////nonexistent/replica.db")
+    monkeypatch.setattr(database, "SessionLocal", TestingSessionLocal)
+    monkeypatch.setattr(database, "replicas", database.ReplicaSet([replica]))
+
+    def read_bind(pinned_until=None):
+        headers = []
+        if pinned_until is not None:
+            cookie = f"{database.PRIMARY_PIN_COOKIE}={pinned_until}"
+            headers.append((b"cookie", cookie.encode()))
+        dependency = get_read_db(Request({"type": "http", "headers": headers}))
+        bind = next(dependency).get_bind()
+        dependency.close()
+        return bind
+
+    assert read_bind() is replica
+    assert read_bind(time.time() + 5) is engine
+    assert read_bind(time.time() - 1) is replica
+    assert read_bind("broken") is replica
+
+    monkeypatch.setattr(database, "replicas", database.ReplicaSet([broken]))
+    assert read_bind() is engine
+    assert not database.replicas.candidates()
+
+
+def test_engine_options_transaction_pooler(monkeypatch):
+    """engine_options_transaction_pooler"""
+    monkeypatch.setattr(database, "DB_POOLER_MODE", "transaction")
+    options = database.engine_options("postgresql://db/app", is_async=True)
+    assert options["poolclass"] is NullPool
+    assert options["connect_args"]["statement_cache_size"] == 0
+    monkeypatch.setattr(database, "DB_POOLER_MODE", "session")
+    options = database.engine_options("postgresql://db/app")
+    assert options["poolclass"] is database.InstrumentedQueuePool
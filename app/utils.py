@@ -1,12 +1,21 @@
 """utils"""
+import base64
+import binascii
+import json
 from datetime import datetime
 from typing import Type
 from urllib.parse import urlencode
 
-from fastapi import Query
+from fastapi import HTTPException, Query
+from sqlalchemy import or_, tuple_
+from sqlalchemy.orm import raiseload
 
+from app import database
 from app.database import Base
 
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
 
 def build_url_with_query(base_url, **kwargs):
     """build_url_with_query"""
@@ -14,16 +23,173 @@ def build_url_with_query(base_url, **kwargs):
     return f"{base_url}?{query_string}"
 
 
+def sort_column(model: Type[Base], sort_by: str):
+    """sort_column"""
+    if sort_by and sort_by in model.__table__.columns:
+        return getattr(model, sort_by)
+    return None
+
+
 def order_query(
-    model: Type[Base], query: Query, sort_by: str, sort_order: int
+    model: Type[Base], query: Query, sort_by: str, sort_order: int, reverse=False
 ) -> Query:
     """order_query"""
-    if sort_by and hasattr(model, sort_by):
-        if sort_order:
-            query = query.order_by(getattr(model, sort_by).desc())
+    descending = bool(sort_order) != reverse
+    column = sort_column(model, sort_by)
+    if column is not None:
+        # NULL считается больше любого значения, как в индексах postgres
+        if descending:
+            query = query.order_by(column.desc().nulls_first())
+        else:
+            query = query.order_by(column.asc().nulls_last())
+    return query.order_by(model.id.desc() if descending else model.id.asc())
+
+
+def with_loaders(query: Query, *options) -> Query:
+    """with_loaders"""
+    if database.STRICT_LOADING:
+        options = (*options, raiseload("*"))
+    return query.options(*options)
+
+
+def encode_cursor(values) -> str:
+    """encode_cursor"""
+    data = json.dumps(
+        values,
+        default=lambda value: value.isoformat(),
+        separators=(",", ":"),
+    )
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    """decode_cursor"""
+    try:
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(data)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as exc:
+        raise HTTPException(status_code=400, detail="Invalid cursor") from exc
+    if not isinstance(values, list) or len(values) != 2:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+class Keyset:  # pylint: disable=R0902
+    """keyset pagination over (sort column or search rank, id)"""
+
+    def __init__(  # pylint: disable=R0913,R0917
+        self,
+        model: Type[Base],
+        sort_by: str = None,
+        sort_order: int = None,
+        after: str = None,
+        before: str = None,
+        limit: int = PAGE_SIZE,
+        rank=None,
+    ):
+        self.model = model
+        self.sort_by = sort_by
+        self.sort_order = sort_order
+        self.column = sort_column(model, sort_by)
+        # релевантность поиска используется, только если не выбрана сортировка
+        self.rank = rank if self.column is None else None
+        self.key = self.column if self.rank is None else self.rank
+        self.descending = bool(sort_order) if self.rank is None else True
+        self.backwards = bool(before)
+        self.cursor = decode_cursor(before or after) if before or after else None
+        self.limit = limit
+
+    def _cursor_value(self, value):
+        """_cursor_value"""
+        if value is None or self.key is None:
+            return value
+        try:
+            python_type = self.key.type.python_type
+        except NotImplementedError:
+            return value
+        try:
+            if python_type is datetime:
+                return datetime.fromisoformat(value)
+            return python_type(value)
+        except (TypeError, ValueError) as exc:
+            raise HTTPException(status_code=400, detail="Invalid cursor") from exc
+
+    def _after(self, descending):
+        """condition for rows that follow the cursor in the given direction"""
+        value, last_id = self.cursor
+        value = self._cursor_value(value)
+        if not isinstance(last_id, int):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        model_id = self.model.id
+        key = self.key
+        if key is None:
+            return model_id < last_id if descending else model_id > last_id
+        if value is None:
+            if descending:
+                return or_(key.isnot(None), model_id < last_id)
+            return (key.is_(None)) & (model_id > last_id)
+        if descending:
+            return tuple_(key, model_id) < tuple_(value, last_id)
+        condition = tuple_(key, model_id) > tuple_(value, last_id)
+        if getattr(key, "nullable", True):
+            condition = or_(condition, key.is_(None))
+        return condition
+
+    def apply(self, query: Query) -> Query:
+        """apply"""
+        descending = self.descending != self.backwards
+        if self.cursor is not None:
+            query = query.filter(self._after(descending))
+        if self.rank is not None:
+            query = query.add_columns(self.rank).order_by(
+                self.rank.desc() if descending else self.rank.asc(),
+                self.model.id.desc() if descending else self.model.id.asc(),
+            )
         else:
-            query = query.order_by(getattr(model, sort_by))
-    return query
+            query = order_query(
+                self.model, query, self.sort_by, self.sort_order, reverse=self.backwards
+            )
+        return query.limit(self.limit + 1)
+
+    def _encode(self, row):
+        """_encode"""
+        if self.rank is not None:
+            value = row[1]
+        elif self.column is not None:
+            value = getattr(row[0], self.sort_by)
+        else:
+            value = None
+        return encode_cursor([value, row[0].id])
+
+    def page(self, rows):
+        """split fetched rows into the page and its next/prev cursors"""
+        rows = list(rows)
+        has_more = len(rows) > self.limit
+        rows = rows[: self.limit]
+        if self.backwards:
+            rows.reverse()
+        if not rows:
+            return rows, None, None
+        if self.backwards:
+            next_cursor = self._encode(rows[-1])
+            prev_cursor = self._encode(rows[0]) if has_more else None
+        else:
+            next_cursor = self._encode(rows[-1]) if has_more else None
+            prev_cursor = self._encode(rows[0]) if self.cursor is not None else None
+        return [row[0] for row in rows], next_cursor, prev_cursor
+
+
+def page_links(request, next_cursor, prev_cursor):
+    """page_links"""
+    url = request.url.remove_query_params(["after", "before"])
+    links = {"next_url": None, "prev_url": None}
+    if next_cursor:
+        next_page = url.include_query_params(after=next_cursor)
+        links["next_url"] = f"{next_page.path}?{next_page.query}"
+    if prev_cursor:
+        prev_page = url.include_query_params(before=prev_cursor)
+        links["prev_url"] = f"{prev_page.path}?{prev_page.query}"
+    return links
 
 
 def format_price(value):
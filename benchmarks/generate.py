@@ -0,0 +1,167 @@
+"""Deterministic synthetic dataset for load tests.
+
+Fills events, visitors and registrations through multi-row INSERTs in
+chunks, then rebuilds the event counters. The same --seed always produces
+the same rows, so runs on different days are comparable.
+
+    python -m benchmarks.generate --events 100000 --visitors 1000000 \\
+        --registrations 5000000
+"""
+import argparse
+import random
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import create_engine, delete, insert
+
+from app import models
+from config import DATABASE_URL
+
+CHUNK_SIZE = 10_000
+EPOCH = datetime(2026, 1, 1)
+STATUSES = ["planning", "ready", "active", "completed", "cancelled"]
+WORDS = (
+    "conference meetup concert lecture workshop festival hackathon exhibition "
+    "seminar webinar forum screening marathon tasting quiz"
+).split()
+CITIES = "Moscow Kazan Samara Perm Tomsk Omsk Tula Sochi Ufa Penza".split()
+FIRST_NAMES = "Anna Ivan Olga Petr Maria Sergey Elena Pavel Irina Denis".split()
+LAST_NAMES = "Ivanov Petrov Sidorov Smirnov Kuznetsov Popov Sokolov Lebedev".split()
+
+
+def events(rng, count):
+    """events"""
+    for i in range(1, count + 1):
+        start_at = EPOCH + timedelta(hours=rng.randrange(0, 24 * 730))
+        yield {
+            "id": i,
+            "title": f"{rng.choice(WORDS).title()} {rng.choice(WORDS)} #{i}",
+            "description": " ".join(rng.choices(WORDS, k=8)),
+            "status": rng.choice(STATUSES),
+            "location": f"{rng.choice(CITIES)}, hall {rng.randrange(1, 50)}",
+            "start_at": start_at,
+            "end_at": start_at + timedelta(hours=rng.randrange(1, 72)),
+            "price": rng.choice((0, 500, 1000, 1500, 3000)),
+            "visitor_limit": rng.choice((None, 0, 100, 500, 1000)),
+        }
+
+
+def visitors(rng, count):
+    """visitors"""
+    for i in range(1, count + 1):
+        yield {
+            "id": i,
+            "first_name": rng.choice(FIRST_NAMES),
+            "last_name": rng.choice(LAST_NAMES),
+            "phone": f"7{i:010d}",
+            "email": f"visitor{i}@example.com" if rng.random() < 0.8 else None,
+        }
+
+
+def registrations(rng, count, event_count, visitor_count, prices):
+    """registrations; event i % E gets visitors at distinct offsets, so every
+    (event_id, visitor_id) pair is unique while count <= E * V"""
+    for i in range(count):
+        event_id = i % event_count + 1
+        visitor_id = (i // event_count + event_id * 7919) % visitor_count + 1
+        price = prices[event_id - 1]
+        paid_at = EPOCH + timedelta(minutes=rng.randrange(0, 525_600))
+        roll = rng.random()
+        row = {
+            "id": i + 1,
+            "event_id": event_id,
+            "visitor_id": visitor_id,
+            "price": price,
+            "status": "unpaid",
+            "billed_amount": None,
+            "refund_amount": None,
+            "billed_at": None,
+            "refunded_at": None,
+        }
+        if roll < 0.35:
+            row.update(status="paid", billed_amount=price, billed_at=paid_at)
+        elif roll < 0.40:
+            row.update(
+                status="refunded",
+                billed_amount=price,
+                billed_at=paid_at,
+                refund_amount=price,
+                refunded_at=paid_at + timedelta(days=1),
+            )
+        yield row
+
+
+def load(connection, model, rows, chunk_size):
+    """multi-row INSERTs, one transaction per chunk"""
+    started = time.perf_counter()
+    total = 0
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            connection.execute(insert(model), chunk)
+            connection.commit()
+            total += len(chunk)
+            chunk = []
+    if chunk:
+        connection.execute(insert(model), chunk)
+        connection.commit()
+        total += len(chunk)
+    elapsed = time.perf_counter() - started
+    print(
+        f"{model.__tablename__:<14} {total:>10} строк за {elapsed:7.1f} с "
+        f"({total / max(elapsed, 1e-9):,.0f} строк/с)"
+    )
+
+
+def main(argv=None):
+    """main"""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.generate")
+    parser.add_argument("--events", type=int, default=100_000)
+    parser.add_argument("--visitors", type=int, default=1_000_000)
+    parser.add_argument("--registrations", type=int, default=5_000_000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE)
+    parser.add_argument(
+        "--truncate", action="store_true", help="удалить существующие данные"
+    )
+    args = parser.parse_args(argv)
+    if args.registrations > args.events * args.visitors:
+        parser.error("registrations must not exceed events * visitors")
+
+    engine = create_engine(DATABASE_URL)
+    with engine.connect() as connection:
+        if args.truncate:
+            for model in (models.Registration, models.Visitor, models.Event):
+                connection.execute(delete(model))
+            connection.commit()
+        rng = random.Random(args.seed)
+        event_rows = list(events(rng, args.events))
+        load(connection, models.Event, event_rows, args.chunk_size)
+        load(connection, models.Visitor, visitors(rng, args.visitors), args.chunk_size)
+        prices = [row["price"] for row in event_rows]
+        del event_rows
+        load(
+            connection,
+            models.Registration,
+            registrations(rng, args.registrations, args.events, args.visitors, prices),
+            args.chunk_size,
+        )
+        started = time.perf_counter()
+        models.rebuild_event_counters(connection)
+        connection.commit()
+        print(f"счётчики мероприятий пересчитаны за {time.perf_counter() - started:.1f} с")
+        if connection.dialect.name == "postgresql":
+            # id заданы явно, сдвигаем последовательности за них
+            for model in (models.Event, models.Visitor, models.Registration):
+                table = model.__tablename__
+                connection.exec_driver_sql(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                    f"(SELECT max(id) FROM {table}))"
+                )
+            connection.exec_driver_sql("ANALYZE")
+            connection.commit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""Throughput and latency percentiles per endpoint, stored for comparison.
+
+A run is saved as JSON in benchmarks/results/. Printing a saved run, or
+two runs side by side:
+
+    python -m benchmarks.report benchmarks/results/20261017-120000.json
+    python -m benchmarks.report old.json new.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+from datetime import datetime
+
+RESULTS_DIR = os.path.join(os.path.dirname(__file__), "results")
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, share):
+    """nearest-rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    rank = max(0, min(len(values) - 1, round(share / 100 * len(values)) - 1))
+    return values[rank]
+
+
+def summarize(samples, seconds):
+    """samples: endpoint -> list of (latency seconds, status code)"""
+    endpoints = {}
+    for endpoint, results in sorted(samples.items()):
+        latencies = sorted(latency * 1000 for latency, _ in results)
+        endpoints[endpoint] = {
+            "requests": len(results),
+            "errors": sum(status >= 400 for _, status in results),
+            "rps": len(results) / seconds if seconds else 0.0,
+            **{f"p{share}_ms": percentile(latencies, share) for share in PERCENTILES},
+        }
+    return endpoints
+
+
+def git_revision():
+    """git_revision"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save(endpoints, settings, directory=RESULTS_DIR):
+    """save"""
+    os.makedirs(directory, exist_ok=True)
+    started = datetime.now()
+    path = os.path.join(directory, f"{started:%Y%m%d-%H%M%S}.json")
+    run = {
+        "started_at": started.isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "settings": settings,
+        "endpoints": endpoints,
+    }
+    with open(path, "w", encoding="utf-8") as stream:
+        json.dump(run, stream, indent=2, ensure_ascii=False)
+    return path
+
+
+def load(path):
+    """load"""
+    with open(path, encoding="utf-8") as stream:
+        return json.load(stream)
+
+
+def show(run, baseline=None):
+    """table of endpoints; with a baseline, change of rps and p95 in percent"""
+    print(f"{run['started_at']}  rev {run.get('revision') or '-'}  {run['settings']}")
+    header = f"{'endpoint':<28}{'requests':>9}{'errors':>7}{'rps':>9}" + "".join(
+        f"{f'p{share} ms':>10}" for share in PERCENTILES
+    )
+    print(header + ("   Δrps    Δp95" if baseline else ""))
+    for endpoint, stats in run["endpoints"].items():
+        line = (
+            f"{endpoint:<28}{stats['requests']:>9}{stats['errors']:>7}"
+            f"{stats['rps']:>9.1f}"
+            + "".join(f"{stats[f'p{share}_ms']:>10.2f}" for share in PERCENTILES)
+        )
+        before = (baseline or {}).get("endpoints", {}).get(endpoint)
+        if before:
+            line += f"{change(before['rps'], stats['rps']):>7}"
+            line += f"{change(before['p95_ms'], stats['p95_ms']):>8}"
+        print(line)
+
+
+def change(before, after):
+    """change"""
+    if not before:
+        return "-"
+    return f"{(after - before) / before * 100:+.0f}%"
+
+
+def main(argv=None):
+    """main"""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.report")
+    parser.add_argument("runs", nargs="+", help="один прогон или базовый и новый")
+    args = parser.parse_args(argv)
+    if len(args.runs) == 1:
+        show(load(args.runs[0]))
+    else:
+        show(load(args.runs[-1]), load(args.runs[0]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""Scenario runner: drives the real routes of a running server concurrently.
+
+Workers pick scenarios by weight with a seeded RNG, so the request mix is
+repeatable. Latencies are collected per endpoint, printed and saved by
+benchmarks.report for later comparison.
+
+    python -m benchmarks.run --base-url http://localhost:8000 \\
+        --concurrency 32 --duration 60
+"""
+#pylint: disable=R0913,R0914,R0917
+import argparse
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from benchmarks import report
+
+SEARCH_TERMS = ("conference", "concert", "Kazan", "hall 7", "workshop")
+
+
+def max_id(client, path):
+    """largest id through the JSON API, newest first"""
+    items = client.get(path, params={"limit": 1, "sort_order": 1}).json()["items"]
+    return items[0]["id"] if items else 1
+
+
+def scenarios(events, visitors):
+    """name -> (weight, request builder taking an RNG)"""
+    return {
+        "GET /events/": (20, lambda rng: ("GET", "/events/", {})),
+        "GET /events/?search": (
+            10,
+            lambda rng: ("GET", "/events/", {"search": rng.choice(SEARCH_TERMS)}),
+        ),
+        "GET /events/{id}": (
+            25,
+            lambda rng: ("GET", f"/events/{rng.randint(1, events)}", {}),
+        ),
+        "GET /visitors/": (5, lambda rng: ("GET", "/visitors/", {})),
+        "GET /visitors/{id}": (
+            10,
+            lambda rng: ("GET", f"/visitors/{rng.randint(1, visitors)}", {}),
+        ),
+        "GET /registrations/?event": (
+            10,
+            lambda rng: (
+                "GET",
+                "/registrations/",
+                {"event_id": rng.randint(1, events)},
+            ),
+        ),
+        "GET /api/events/{id}": (
+            10,
+            lambda rng: ("GET", f"/api/events/{rng.randint(1, events)}", {}),
+        ),
+        "POST /registrations/create/": (
+            10,
+            lambda rng: (
+                "POST",
+                "/registrations/create/",
+                {
+                    "event_id": rng.randint(1, events),
+                    "visitor_id": rng.randint(1, visitors),
+                },
+            ),
+        ),
+    }
+
+
+def worker(base_url, plan, deadline, seed, samples, lock):
+    """worker"""
+    rng = random.Random(seed)
+    names = list(plan)
+    weights = [plan[name][0] for name in names]
+    local = defaultdict(list)
+    # запись ставит cookie чтения с primary: чтения идут отдельным клиентом,
+    # иначе после первой же регистрации они не попадут на реплики
+    with httpx.Client(base_url=base_url, timeout=30) as reader, httpx.Client(
+        base_url=base_url, timeout=30
+    ) as writer:
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights)[0]
+            method, path, params = plan[name][1](rng)
+            started = time.perf_counter()
+            if method == "GET":
+                response = reader.get(path, params=params)
+            else:
+                response = writer.post(path, data=params)
+            local[name].append((time.perf_counter() - started, response.status_code))
+    with lock:
+        for name, results in local.items():
+            samples[name].extend(results)
+
+
+def main(argv=None):
+    """main"""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.run")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=30)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--read-only", action="store_true", help="без POST /registrations/create/"
+    )
+    args = parser.parse_args(argv)
+
+    with httpx.Client(base_url=args.base_url) as client:
+        plan = scenarios(
+            max_id(client, "/api/events/"), max_id(client, "/api/visitors/")
+        )
+    if args.read_only:
+        plan = {name: value for name, value in plan.items() if name.startswith("GET")}
+
+    samples = defaultdict(list)
+    lock = threading.Lock()
+    started = time.perf_counter()
+    deadline = started + args.duration
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [
+            pool.submit(
+                worker, args.base_url, plan, deadline, args.seed + number, samples, lock
+            )
+            for number in range(args.concurrency)
+        ]
+        for future in futures:
+            future.result()
+    seconds = time.perf_counter() - started
+
+    endpoints = report.summarize(samples, seconds)
+    settings = {
+        "base_url": args.base_url,
+        "concurrency": args.concurrency,
+        "duration": args.duration,
+        "seed": args.seed,
+    }
+    path = report.save(endpoints, settings)
+    report.show(report.load(path))
+    print(f"сохранено в {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Search latency: ILIKE sequential scan vs trigram index (postgres).
+
+Builds a scratch copy of the events search columns with N generated rows,
+times the search query of get_events before and after creating the GIN
+trigram indexes from the add_trigram_search_indexes migration, and drops
+the scratch table afterwards.
+
+    python -m benchmarks.search --rows 1000000 --term 7f3a
+"""
+import argparse
+import statistics
+import time
+
+from sqlalchemy import create_engine, text
+
+from config import DATABASE_URL
+
+TABLE = "bench_search_events"
+COLUMNS = ("title", "description", "location")
+
+SEARCH = f"""
+    SELECT id FROM {TABLE}
+    WHERE title ILIKE :pattern OR description ILIKE :pattern OR location ILIKE :pattern
+    ORDER BY id LIMIT 50
+"""
+RANKED_SEARCH = f"""
+    SELECT id FROM {TABLE}
+    WHERE title ILIKE :pattern OR description ILIKE :pattern OR location ILIKE :pattern
+    ORDER BY greatest(
+        word_similarity(:term, title),
+        word_similarity(:term, description),
+        word_similarity(:term, location)
+    ) DESC, id DESC
+    LIMIT 50
+"""
+
+
+def populate(connection, rows):
+    """populate"""
+    connection.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+    connection.execute(
+        text(
+            f"""
+            CREATE TABLE {TABLE} (
+                id serial PRIMARY KEY,
+                title varchar(255) NOT NULL,
+                description varchar(255),
+                location varchar(255) NOT NULL
+            )
+            """
+        )
+    )
+    connection.execute(
+        text(
+            f"""
+            INSERT INTO {TABLE} (title, description, location)
+            SELECT
+                'Event ' || md5(i::text),
+                'Description ' || md5((i * 7)::text) || ' ' || md5((i * 13)::text),
+                'Hall ' || (i % 500)::text || ' ' || md5((i * 3)::text)
+            FROM generate_series(1, :rows) AS i
+            """
+        ),
+        {"rows": rows},
+    )
+    connection.execute(text(f"ANALYZE {TABLE}"))
+
+
+def create_indexes(connection):
+    """create_indexes"""
+    connection.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    for column in COLUMNS:
+        connection.execute(
+            text(
+                f"CREATE INDEX {TABLE}_{column}_trgm ON {TABLE} "
+                f"USING gin ({column} gin_trgm_ops)"
+            )
+        )
+    connection.execute(text(f"ANALYZE {TABLE}"))
+
+
+def measure(connection, sql, term, repeat):
+    """median and p95 latency in milliseconds, plus the plan of the query"""
+    params = {"pattern": f"%{term}%", "term": term}
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        connection.execute(text(sql), params).all()
+        timings.append((time.perf_counter() - started) * 1000)
+    plan = connection.execute(text(f"EXPLAIN {sql}"), params).scalars().all()
+    timings.sort()
+    return {
+        "median_ms": statistics.median(timings),
+        "p95_ms": timings[max(0, int(len(timings) * 0.95) - 1)],
+        "plan": plan[0] if plan else "",
+        "uses_index": any("_trgm" in line for line in plan),
+    }
+
+
+def report(label, result):
+    """report"""
+    print(
+        f"{label:<28} median {result['median_ms']:9.2f} ms  "
+        f"p95 {result['p95_ms']:9.2f} ms  "
+        f"index: {'yes' if result['uses_index'] else 'no '}  {result['plan']}"
+    )
+
+
+def main(argv=None):
+    """main"""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.search")
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--term", default="7f3a")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--keep", action="store_true", help="не удалять таблицу")
+    args = parser.parse_args(argv)
+
+    engine = create_engine(DATABASE_URL)
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level="AUTOCOMMIT")
+        print(f"Заполнение {TABLE}: {args.rows} строк")
+        populate(connection, args.rows)
+        try:
+            report("ILIKE, seq scan", measure(connection, SEARCH, args.term, args.repeat))
+            create_indexes(connection)
+            report("ILIKE, trigram", measure(connection, SEARCH, args.term, args.repeat))
+            report(
+                "ILIKE + rank, trigram",
+                measure(connection, RANKED_SEARCH, args.term, args.repeat),
+            )
+        finally:
+            if not args.keep:
+                connection.execute(text(f"DROP TABLE IF EXISTS {TABLE}"))
+
+
+if __name__ == "__main__":
+    main()
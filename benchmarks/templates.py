@@ -0,0 +1,123 @@
+"""Template load time: compiling on first use vs bytecode cache vs warmed worker.
+
+Each round builds a fresh Jinja environment the way a new worker does and
+loads every template: once compiling from source, once from the bytecode
+cache filled by ``python -m app.cli compile-templates``. Then the events page
+template is loaded in a cold environment and in one already warmed at startup.
+The last lines start the app in a fresh interpreter: worker boot (import and
+lifespan) and the first request to ``/``, without and with the bytecode cache.
+
+    python -m benchmarks.templates --repeat 20
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from jinja2 import Environment, FileSystemLoader
+
+from app.templating import TEMPLATE_DIR, bytecode_cache, templates, warm_templates
+
+PAGE = "event/index.html"
+# новый интерпретатор: импорты и шаблоны не прогреты предыдущими замерами
+BOOT_SCRIPT = """
+import time
+from fastapi.testclient import TestClient
+started = time.perf_counter()
+from app.main import app
+with TestClient(app) as client:
+    booted = time.perf_counter()
+    client.get("/")
+    print(booted - started, time.perf_counter() - booted)
+"""
+
+
+def environment(cache=None):
+    """environment like the one Jinja2Templates builds, filters included"""
+    env = Environment(
+        loader=FileSystemLoader(TEMPLATE_DIR), autoescape=True, bytecode_cache=cache
+    )
+    env.filters.update(templates.env.filters)
+    env.globals.update(templates.env.globals)
+    return env
+
+
+def measure(make_env, action, repeat):
+    """median and max in milliseconds over fresh environments"""
+    timings = []
+    for _ in range(repeat):
+        env = make_env()
+        started = time.perf_counter()
+        action(env)
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), max(timings)
+
+
+def measure_boot(cache_dir, repeat):
+    """median and max of worker boot and of the first request, in milliseconds"""
+    env = {**os.environ, "TEMPLATE_CACHE_DIR": cache_dir}
+    # для старта и запроса к "/" база не нужна
+    env.setdefault("DATABASE_URL", "sqlite://")
+    boots, firsts = [], []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", BOOT_SCRIPT],
+            env=env,
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.split()
+        boots.append(float(output[-2]) * 1000)
+        firsts.append(float(output[-1]) * 1000)
+    return (statistics.median(boots), max(boots)), (
+        statistics.median(firsts),
+        max(firsts),
+    )
+
+
+def report(label, result):
+    """report"""
+    print(f"{label:<32} median {result[0]:8.2f} ms  max {result[1]:8.2f} ms")
+
+
+def main(argv=None):
+    """main"""
+    parser = argparse.ArgumentParser(prog="python -m benchmarks.templates")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as directory:
+        cache = bytecode_cache(directory)
+        warm_templates(environment(cache))
+        report(
+            "all templates, compile",
+            measure(environment, warm_templates, args.repeat),
+        )
+        report(
+            "all templates, bytecode cache",
+            measure(lambda: environment(cache), warm_templates, args.repeat),
+        )
+
+        def load_page(env):
+            env.get_template(PAGE)
+
+        report(f"{PAGE}, cold worker", measure(environment, load_page, args.repeat))
+
+        def warmed():
+            env = environment(cache)
+            warm_templates(env)
+            return env
+
+        report(f"{PAGE}, warmed worker", measure(warmed, load_page, args.repeat))
+
+        for label, cache_dir in (("no bytecode cache", ""), ("bytecode cache", directory)):
+            booted, first = measure_boot(cache_dir, args.repeat)
+            report(f"worker boot, {label}", booted)
+            report(f"first request, {label}", first)
+
+
+if __name__ == "__main__":
+    main()